@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cohort tensor: all subjects' first-level con maps of a pipeline sink in one
+file
+
+Per sink (Sink_resp, Sink_resp_sv, ...), the con images of every subject
+and contrast are packed once into a [subject, contrast, in-mask voxel]
+float32 memmap. Subjects are the outer axis, so adding a subject appends
+its rows to the end of the file, and group tests read one sequential file
+instead of opening subjects * contrasts images.
+
+Layout (<sink>/cohort/):
+    cohort.dat         float32, subject * contrast * voxel, C order
+    voxel_index.npy    flat (C order) indices of the voxels in the volume
+    cohort.json        subjects, contrasts, volume shape, affine
+"""
+import os
+import json
+import numpy as np
+
+#%%
+def read_cohort_meta(cohort_dir):
+    '''
+    Metadata of a cohort: dict with subjects, contrasts, shape, affine and
+    voxel_index
+    '''
+    with open(os.path.join(cohort_dir, 'cohort.json')) as f:
+        meta = json.load(f)
+    meta['affine'] = np.array(meta['affine'])
+    meta['shape'] = tuple(meta['shape'])
+    meta['voxel_index'] = np.load(os.path.join(cohort_dir, 'voxel_index.npy'))
+
+    return meta
+
+#%%
+def _write_cohort_meta(cohort_dir, meta):
+    # write then rename, so a reader never sees a partial index
+    tmp_file = os.path.join(cohort_dir, 'cohort.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'subjects': meta['subjects'], 'contrasts': meta['contrasts'],
+                   'shape': list(meta['shape']), 'affine': np.asarray(meta['affine']).tolist()},
+                  f, indent=1)
+    os.replace(tmp_file, os.path.join(cohort_dir, 'cohort.json'))
+
+#%%
+def subject_con_files(first_level_dir, subject, contrasts):
+    '''
+    A subject's con images in a first-level sink
+    '''
+    return [os.path.join(first_level_dir, '_subject_id_%s' % subject, '%s.nii' % contrast)
+            for contrast in contrasts]
+
+#%%
+def build_cohort(cohort_dir, first_level_dir, subjects, contrasts, mask_file=None):
+    '''
+    Create a cohort, or append the subjects it does not hold yet
+
+    Input:
+        cohort_dir: e.g. Sink_resp/cohort
+        first_level_dir: e.g. Sink_resp/1stLevel
+        subjects: list of subject ids
+        contrasts: list of contrast names, e.g. ['con_0001', 'con_0002']
+        mask_file: voxels to keep when creating the cohort; default the
+            voxels finite and non-zero in the first contrast of any subject
+
+    Output:
+        meta: cohort metadata (see read_cohort_meta)
+    '''
+    import nibabel as nib
+
+    subjects = [str(sub) for sub in subjects]
+
+    if os.path.exists(os.path.join(cohort_dir, 'cohort.json')):
+        meta = read_cohort_meta(cohort_dir)
+        missing = [c for c in contrasts if c not in meta['contrasts']]
+        if missing:
+            raise ValueError('%s not in the cohort %s, rebuild it' % (missing, cohort_dir))
+    else:
+        os.makedirs(cohort_dir, exist_ok=True)
+        first = nib.load(subject_con_files(first_level_dir, subjects[0], contrasts)[0])
+
+        if mask_file is not None:
+            mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+        else:
+            mask = np.zeros(first.shape[:3], dtype=bool)
+            for sub in subjects:
+                con_file = subject_con_files(first_level_dir, sub, contrasts[:1])[0]
+                vol = np.asanyarray(nib.load(con_file).dataobj)
+                mask |= np.isfinite(vol) & (vol != 0)
+
+        meta = {'subjects': [], 'contrasts': list(contrasts), 'shape': first.shape[:3],
+                'affine': first.affine, 'voxel_index': np.flatnonzero(mask)}
+        np.save(os.path.join(cohort_dir, 'voxel_index.npy'), meta['voxel_index'])
+        open(os.path.join(cohort_dir, 'cohort.dat'), 'wb').close()
+
+    new_subjects = [sub for sub in subjects if sub not in meta['subjects']]
+    voxel_index = meta['voxel_index']
+    rows = np.empty((len(meta['contrasts']), len(voxel_index)), dtype=np.float32)
+
+    with open(os.path.join(cohort_dir, 'cohort.dat'), 'r+b') as f:
+        # drop any rows of an interrupted append beyond the indexed subjects
+        f.truncate(len(meta['subjects']) * rows.nbytes)
+        f.seek(0, os.SEEK_END)
+        for sub in new_subjects:
+            for (con_idx, con_file) in enumerate(subject_con_files(first_level_dir, sub,
+                                                                   meta['contrasts'])):
+                vol = np.asanyarray(nib.load(con_file).dataobj, dtype=np.float32)
+                rows[con_idx] = vol.ravel()[voxel_index]
+            f.write(rows.tobytes())
+            meta['subjects'].append(sub)
+
+    _write_cohort_meta(cohort_dir, meta)
+
+    return meta
+
+#%%
+def open_cohort(cohort_dir):
+    '''
+    Read-only memmap of a cohort
+
+    Output:
+        data: float32 memmap, subject * contrast * voxel
+        meta: cohort metadata (see read_cohort_meta)
+    '''
+    meta = read_cohort_meta(cohort_dir)
+    shape = (len(meta['subjects']), len(meta['contrasts']), len(meta['voxel_index']))
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=np.float32), meta
+
+    data = np.memmap(os.path.join(cohort_dir, 'cohort.dat'), dtype=np.float32, mode='r',
+                     shape=shape)
+
+    return data, meta
+
+#%%
+def load_cohort_stack(cohort_dir, subjects=None, contrasts=None):
+    '''
+    Contrast stack from a cohort, as group_level.load_contrast_stack
+
+    Input:
+        cohort_dir: cohort folder
+        subjects: list of subject ids, default all
+        contrasts: list of contrast names, default all
+
+    Output:
+        data: float32 array, contrast * subject * voxel, restricted to the
+            voxels finite and non-zero in every selected subject (spm's
+            implicit mask)
+        mask: boolean 3D mask of these voxels
+        affine: affine of the images
+    '''
+    cohort, meta = open_cohort(cohort_dir)
+
+    sub_idx = (list(range(len(meta['subjects']))) if subjects is None
+               else [meta['subjects'].index(str(sub)) for sub in subjects])
+    con_idx = (list(range(len(meta['contrasts']))) if contrasts is None
+               else [meta['contrasts'].index(con) for con in contrasts])
+
+    # subjects are read in file order, one sequential row each
+    order = np.argsort(sub_idx)
+    data = np.empty((len(con_idx), len(sub_idx), cohort.shape[2]), dtype=np.float32)
+    for pos in order:
+        data[:, pos] = cohort[sub_idx[pos]][con_idx]
+
+    valid = np.all(np.isfinite(data[0]) & (data[0] != 0), axis=0)
+    mask = np.zeros(meta['shape'], dtype=bool)
+    mask.ravel()[meta['voxel_index'][valid]] = True
+
+    return data[:, :, valid], mask, meta['affine']
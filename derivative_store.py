@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-subject store of first-level parameter maps
+
+All beta, con and spmT images of a subject go into one chunked HDF5 file
+holding a [map, x, y, z] float32 array, with the map names (file names
+without extension, e.g. 'spmT_0001') as index. ROI and searchlight code can
+then read a few voxel blocks of many maps without opening, decompressing
+and upcasting each image; the NIfTI files can be written back from the
+store for SPM.
+
+Store layout (derivatives.h5):
+    maps      float32, map * x * y * z, 16 * 16 * 16 voxel chunks
+    names     map names, in map order
+    affine    4 * 4
+"""
+import os
+import numpy as np
+
+#%%
+def map_name(map_file):
+    '''
+    Name of a map in the store: file name without extension
+    '''
+    return os.path.basename(map_file).split('.nii')[0]
+
+#%%
+def write_derivative_store(out_file, map_files, chunk=16, compression='lzf'):
+    '''
+    Write parameter maps into one store
+
+    Input:
+        out_file: path of the HDF5 store
+        map_files: list of 3D images, all on the same grid
+        chunk: edge of the cubic voxel chunks
+        compression: h5py compression filter
+
+    Output:
+        out_file: path of the store
+    '''
+    import h5py
+    import nibabel as nib
+
+    first = nib.load(map_files[0])
+    shape = first.shape[:3]
+    chunks = (1,) + tuple(min(chunk, n) for n in shape)
+
+    with h5py.File(out_file, 'w') as store:
+        maps = store.create_dataset('maps', shape=(len(map_files),) + shape,
+                                    dtype=np.float32, chunks=chunks,
+                                    compression=compression)
+        for (map_idx, map_file) in enumerate(map_files):
+            img = nib.load(map_file)
+            if img.shape[:3] != shape or not np.allclose(img.affine, first.affine):
+                raise ValueError('%s is not on the grid of %s' % (map_file, map_files[0]))
+            maps[map_idx] = np.asanyarray(img.dataobj, dtype=np.float32).reshape(shape)
+
+        store.create_dataset('names', data=np.array([map_name(f) for f in map_files], dtype='S'))
+        store.create_dataset('affine', data=first.affine)
+
+    return out_file
+
+#%%
+def store_map_names(store_file):
+    '''
+    List of map names in a store, in map order
+    '''
+    import h5py
+
+    with h5py.File(store_file, 'r') as store:
+        return [name.decode() for name in store['names'][()]]
+
+#%%
+def _map_indices(store, names):
+    all_names = [name.decode() for name in store['names'][()]]
+    if names is None:
+        return list(range(len(all_names)))
+
+    return [all_names.index(name) for name in names]
+
+#%%
+def read_maps(store_file, names=None, block=None):
+    '''
+    Read maps, or a voxel block of maps, from a store
+
+    Input:
+        store_file: path of the store
+        names: list of map names, default all maps
+        block: optional tuple of 3 slices (x, y, z)
+
+    Output:
+        data: float32 array, map * x * y * z (block shape if given)
+    '''
+    import h5py
+
+    if block is None:
+        block = (slice(None),) * 3
+
+    with h5py.File(store_file, 'r') as store:
+        map_idx = _map_indices(store, names)
+        # h5py wants increasing indices for a fancy read
+        order = np.argsort(map_idx)
+        data = store['maps'][(list(np.array(map_idx)[order]),) + tuple(block)]
+
+    return data[np.argsort(order)]
+
+#%%
+def read_voxels(store_file, voxel_index, names=None):
+    '''
+    Read a set of voxels (e.g. an ROI or a searchlight sphere) from maps
+
+    Only the bounding box of the voxels is read from disk.
+
+    Input:
+        store_file: path of the store
+        voxel_index: flat voxel indices (C order), or an array of ijk
+            coordinates, voxels * 3
+        names: list of map names, default all maps
+
+    Output:
+        data: float32 array, map * voxels
+    '''
+    import h5py
+
+    with h5py.File(store_file, 'r') as store:
+        shape = store['maps'].shape[1:]
+
+    coords = np.asarray(voxel_index)
+    if coords.ndim == 1:
+        coords = np.column_stack(np.unravel_index(coords, shape))
+
+    lo = coords.min(axis=0)
+    hi = coords.max(axis=0) + 1
+    block = tuple(slice(l, h) for (l, h) in zip(lo, hi))
+    data = read_maps(store_file, names, block)
+
+    local = coords - lo
+    return data[:, local[:, 0], local[:, 1], local[:, 2]]
+
+#%%
+def export_nifti(store_file, name, out_file=None):
+    '''
+    Write one map of a store back as a NIfTI image
+
+    Input:
+        store_file: path of the store
+        name: map name, e.g. 'con_0001'
+        out_file: output path, default <name>.nii in the current directory
+
+    Output:
+        out_file: path of the image
+    '''
+    import h5py
+    import nibabel as nib
+
+    if out_file is None:
+        out_file = os.path.abspath(name + '.nii')
+
+    with h5py.File(store_file, 'r') as store:
+        data = store['maps'][_map_indices(store, [name])[0]]
+        affine = store['affine'][()]
+
+    nib.Nifti1Image(data, affine).to_filename(out_file)
+
+    return out_file
+
+#%% Nipype function node
+def pack_derivatives(beta_images, con_images, spmT_images):
+    '''
+    Function node writing a subject's betas, cons and spmT maps into
+    derivatives.h5
+
+    Output:
+        derivative_store: path of derivatives.h5
+    '''
+    from pathlib import Path
+    from derivative_store import write_derivative_store
+
+    derivative_store = str(Path('derivatives.h5').resolve())
+    map_files = []
+    for images in [beta_images, con_images, spmT_images]:
+        if isinstance(images, str):
+            images = [images]
+        map_files += sorted(images)
+
+    return write_derivative_store(derivative_store, map_files)
@@ -18,9 +18,11 @@ out_root = '/home/rj299/project/mdm_analysis/output'
 from nipype.pipeline import engine as pe
 from nipype.algorithms.modelgen import SpecifyModel
 from nipype.interfaces import fsl, utility as niu, io as nio
-from nipype.workflows.fmri.fsl.preprocess import create_susan_smooth
+#from nipype.workflows.fmri.fsl.preprocess import create_susan_smooth
 from nipype.interfaces.io import BIDSDataGrabber
-from niworkflows.interfaces.bids import DerivativesDataSink# as BIDSDerivativesy
+
+from susan import susan_smooth_runs
+from link_sink import LinkDerivativesDataSink # links outputs instead of copying
 
 
 #%%
@@ -129,9 +131,17 @@ runinfo.inputs.motion_columns   = ['trans_x', 'trans_x_derivative1', 'trans_x_de
                                   ['rot_y', 'rot_y_derivative1', 'rot_y_derivative1_power2', 'rot_y_power2'] +\
                                   ['rot_z', 'rot_z_derivative1', 'rot_z_derivative1_power2', 'rot_z_power2']
 
-# SUSAN smoothing
-susan = create_susan_smooth()
-susan.inputs.inputnode.fwhm = fwhm
+# SUSAN smoothing, in python: create_susan_smooth runs several fsl commands
+# per run and writes all their intermediate images
+#susan = create_susan_smooth()
+#susan.inputs.inputnode.fwhm = fwhm
+susan = pe.Node(niu.Function(
+    input_names=['in_files', 'mask_files', 'fwhm', 'n_threads'],
+    function=susan_smooth_runs, output_names=['smoothed_files']),
+    name='susan')
+susan.inputs.fwhm = fwhm
+susan.inputs.n_threads = 4
+susan.n_procs = 4
 
 # create workflow
 workflow = pe.Workflow(name='firstLevel_RA_MDM',base_dir=work_dir)
@@ -182,19 +192,19 @@ feat_select = pe.Node(nio.SelectFiles({
     'zstat': 'stats/zstat*.nii.gz',
 }), name='feat_select')
 
-ds_cope = pe.Node(DerivativesDataSink(
+ds_cope = pe.Node(LinkDerivativesDataSink(
     base_directory=str(output_dir), keep_dtype=False, suffix='cope',
     desc='intask'), name='ds_cope', run_without_submitting=True)
 
-ds_varcope = pe.Node(DerivativesDataSink(
+ds_varcope = pe.Node(LinkDerivativesDataSink(
     base_directory=str(output_dir), keep_dtype=False, suffix='varcope',
     desc='intask'), name='ds_varcope', run_without_submitting=True)
 
-ds_zstat = pe.Node(DerivativesDataSink(
+ds_zstat = pe.Node(LinkDerivativesDataSink(
     base_directory=str(output_dir), keep_dtype=False, suffix='zstat',
     desc='intask'), name='ds_zstat', run_without_submitting=True)
 
-ds_tstat = pe.Node(DerivativesDataSink(
+ds_tstat = pe.Node(LinkDerivativesDataSink(
     base_directory=str(output_dir), keep_dtype=False, suffix='tstat',
     desc='intask'), name='ds_tstat', run_without_submitting=True)
 
@@ -202,10 +212,10 @@ ds_tstat = pe.Node(DerivativesDataSink(
 workflow.connect([
     (infosource, selectfiles, [('subject_id', 'subject_id'), ('task_id', 'task_id')]),
     (selectfiles, runinfo, [('events','events_file'),('regressors','regressors_file')]),
-    (selectfiles, susan, [('func', 'inputnode.in_files'), ('mask','inputnode.mask_file')]),
-    (susan, runinfo, [('outputnode.smoothed_files', 'in_file')]),
-    (susan, l1_spec, [('outputnode.smoothed_files', 'functional_runs')]),
-  #  (susan,modelestimate, [('outputnode.smoothed_files','in_file')]), # try to run FILMGLS
+    (selectfiles, susan, [('func', 'in_files'), ('mask','mask_files')]),
+    (susan, runinfo, [('smoothed_files', 'in_file')]),
+    (susan, l1_spec, [('smoothed_files', 'functional_runs')]),
+  #  (susan,modelestimate, [('smoothed_files','in_file')]), # try to run FILMGLS
     (selectfiles, ds_cope, [('func', 'source_file')]),
     (selectfiles, ds_varcope, [('func', 'source_file')]),
     (selectfiles, ds_zstat, [('func', 'source_file')]),
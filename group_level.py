@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Second-level (group) analysis in numpy
+
+All subjects' con images for all contrasts are stacked into one
+[contrast, subject, voxel] array, and one-sample (or paired) t maps are
+computed for every contrast at once. Outputs follow the layout of the SPM
+second-level workflows: <out_dir>/_contrast_id_<contrast>/con_0001.nii
+(group mean) and spmT_0001.nii.
+"""
+import os
+import numpy as np
+
+#%%
+def load_contrast_stack(con_files, mask=None):
+    '''
+    Stack con images of all contrasts and subjects
+
+    Input:
+        con_files: list (contrasts) of lists (subjects) of con images
+        mask: optional boolean 3D mask; default is the voxels finite and
+            non-zero in every subject (spm's implicit mask), taken from
+            the first contrast since a subject's cons share its mask
+
+    Output:
+        data: float32 array, contrast * subject * in-mask voxel
+        mask: boolean 3D mask
+        affine: affine of the images
+    '''
+    import nibabel as nib
+
+    first = nib.load(con_files[0][0])
+    affine = first.affine
+
+    if mask is None:
+        mask = np.ones(first.shape[:3], dtype=bool)
+        for con_file in con_files[0]:
+            vol = np.asanyarray(nib.load(con_file).dataobj)
+            mask &= np.isfinite(vol) & (vol != 0)
+
+    voxel_index = np.flatnonzero(mask)
+    data = np.empty((len(con_files), len(con_files[0]), len(voxel_index)), dtype=np.float32)
+
+    for (con_idx, con_files_sub) in enumerate(con_files):
+        for (sub_idx, con_file) in enumerate(con_files_sub):
+            vol = np.asanyarray(nib.load(con_file).dataobj, dtype=np.float32)
+            data[con_idx, sub_idx] = vol.ravel()[voxel_index]
+
+    return data, mask, affine
+
+#%%
+def one_sample_t(data):
+    '''
+    One-sample t-test along the subject axis
+
+    Input:
+        data: array, ... * subject * voxel (e.g. contrast * subject * voxel)
+
+    Output:
+        mean: group mean, ... * voxel
+        t: t statistic, ... * voxel
+        df: degrees of freedom
+    '''
+    n_sub = data.shape[-2]
+    mean = data.mean(axis=-2, dtype=np.float64)
+    sd = data.std(axis=-2, ddof=1, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = mean / (sd / np.sqrt(n_sub))
+
+    return mean.astype(np.float32), t.astype(np.float32), n_sub - 1
+
+#%%
+def paired_t(data_a, data_b):
+    '''
+    Paired t-test, a - b, along the subject axis (same layout as one_sample_t)
+    '''
+    return one_sample_t(data_a - data_b)
+
+#%%
+def unmask(values, mask, fill=np.nan):
+    '''
+    Put in-mask voxel values back into volumes
+
+    Input:
+        values: array, ... * in-mask voxel
+        mask: boolean 3D mask
+        fill: value outside the mask
+
+    Output:
+        volumes: float32 array, ... * x * y * z
+    '''
+    volumes = np.full(values.shape[:-1] + (mask.size,), fill, dtype=np.float32)
+    volumes[..., np.flatnonzero(mask)] = values
+
+    return volumes.reshape(values.shape[:-1] + mask.shape)
+
+#%%
+def write_group_maps(out_dir, contrast_names, mean, t, mask, affine):
+    '''
+    Write con_0001.nii (group mean) and spmT_0001.nii for each contrast, in
+    <out_dir>/_contrast_id_<contrast>/ as the spm workflows' datasink
+
+    Output:
+        out_files: dict, contrast: {'con': path, 'spmT': path}
+    '''
+    import nibabel as nib
+
+    out_files = {}
+    for (con_idx, contrast_name) in enumerate(contrast_names):
+        con_dir = os.path.join(out_dir, '_contrast_id_%s' % contrast_name)
+        os.makedirs(con_dir, exist_ok=True)
+
+        out_files[contrast_name] = {}
+        for (map_type, values) in [('con', mean[con_idx]), ('spmT', t[con_idx])]:
+            out_file = os.path.join(con_dir, '%s_0001.nii' % map_type)
+            nib.Nifti1Image(unmask(values, mask), affine).to_filename(out_file)
+            out_files[contrast_name][map_type] = out_file
+
+    return out_files
+
+#%%
+def run_group_ttests(first_level_dir, subjects, contrasts, out_dir, cohort_dir=None):
+    '''
+    One-sample t-tests of all contrasts, from a first-level sink
+
+    Input:
+        first_level_dir: e.g. Sink_resp/1stLevel, with _subject_id_<sub>/
+            <contrast>.nii
+        subjects: list of subject ids
+        contrasts: list of contrast names, e.g. ['con_0001', 'con_0002']
+        out_dir: e.g. Sink_resp/2ndLevel_heightp05
+        cohort_dir: optional cohort folder (cohort_tensor.py), e.g.
+            Sink_resp/cohort; new subjects are appended to it and the data
+            read from it instead of the con images
+
+    Output:
+        out_files: dict, contrast: {'con': path, 'spmT': path}
+    '''
+    if cohort_dir is not None:
+        from cohort_tensor import build_cohort, load_cohort_stack
+
+        build_cohort(cohort_dir, first_level_dir, subjects, contrasts)
+        data, mask, affine = load_cohort_stack(cohort_dir, subjects, contrasts)
+    else:
+        con_files = [[os.path.join(first_level_dir, '_subject_id_%s' % sub, '%s.nii' % contrast)
+                      for sub in subjects]
+                     for contrast in contrasts]
+        data, mask, affine = load_contrast_stack(con_files)
+
+    mean, t, df = one_sample_t(data)
+
+    return write_group_maps(out_dir, contrasts, mean, t, mask, affine)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sign-flip permutation inference for one-sample group maps
+
+Under the null hypothesis subjects' con values are symmetric around 0, so
+flipping the sign of whole subject maps gives null t maps (as FSL randomise
+-1). For every permutation the maximum t and the maximum TFCE over the mask
+build the null distributions for family-wise error corrected p maps.
+
+Permutations are split in fixed chunks, each with its own random stream
+spawned from one seed, and run on a process pool reading the data from
+shared memory: the same seed gives the same result for any number of
+processes.
+
+Outputs follow randomise names, with corrp = 1 - p:
+    tstat1, vox_p_tstat1, vox_corrp_tstat1, tfce_tstat1, tfce_corrp_tstat1
+"""
+import os
+import numpy as np
+
+# data shared with the worker processes, set by _init_worker
+_shared = {}
+
+#%%
+def sign_flip_t(data, signs, sum_sq):
+    '''
+    One-sample t maps for a batch of sign flips
+
+    The sum of squares does not change with the signs, so a batch of
+    permutations is one matrix product.
+
+    Input:
+        data: subject * voxel
+        signs: permutation * subject, +1 / -1
+        sum_sq: sum of squares over subjects, voxel
+
+    Output:
+        t: permutation * voxel
+    '''
+    n_sub = data.shape[0]
+    mean = signs @ data / n_sub
+    var = (sum_sq - n_sub * mean ** 2) / (n_sub - 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = mean / np.sqrt(var / n_sub)
+
+    return np.nan_to_num(t)
+
+#%%
+def exceedance_counts(null, observed):
+    '''
+    Number of null values at least as large as each observed value, from
+    one sort of the null (no permutation * voxel comparison array)
+
+    Input:
+        null: permutation values (e.g. max t of each permutation)
+        observed: values to count for, any shape
+
+    Output:
+        count: int, shape of observed
+    '''
+    null = np.sort(np.asarray(null).ravel())
+
+    return len(null) - np.searchsorted(null, observed, side='left')
+
+#%%
+def _init_worker(raw_data, shape, neighbours, tfce_args):
+    _shared['data'] = np.frombuffer(raw_data, dtype=np.float32).reshape(shape)
+    _shared['sum_sq'] = np.sum(_shared['data'].astype(np.float64) ** 2, axis=0)
+    _shared['neighbours'] = neighbours
+    _shared['tfce_args'] = tfce_args
+
+#%%
+def _permutation_chunk(job):
+    '''
+    Null statistics of one chunk of permutations
+
+    Input:
+        job: (seed sequence of the chunk, number of permutations, observed t,
+            observed tfce or None)
+
+    Output:
+        max_t: maximum t of each permutation
+        max_tfce: maximum tfce of each permutation (None without tfce)
+        count: number of permutations with t >= observed t, per voxel
+    '''
+    from tfce import tfce_in_mask
+
+    seed_seq, n_perm, t_obs, tfce_obs = job
+    data = _shared['data']
+    rng = np.random.default_rng(seed_seq)
+
+    signs = rng.choice([-1.0, 1.0], size=(n_perm, data.shape[0]))
+    t_perm = sign_flip_t(data, signs, _shared['sum_sq'])
+
+    max_t = t_perm.max(axis=1)
+    count = np.sum(t_perm >= t_obs, axis=0)
+
+    max_tfce = None
+    if tfce_obs is not None:
+        max_tfce = np.array([tfce_in_mask(t, neighbours=_shared['neighbours'],
+                                          **_shared['tfce_args']).max()
+                             for t in t_perm])
+
+    return max_t, max_tfce, count
+
+#%%
+def sign_flip_test(data, mask, n_perm=5000, seed=0, n_procs=4, chunk_size=100,
+                   tfce=True, E=0.5, H=2.0, connectivity=26):
+    '''
+    Sign-flip permutation test of a one-sample group map
+
+    Input:
+        data: subject * in-mask voxel array of con values
+        mask: boolean 3D mask the voxels come from
+        n_perm: number of random sign flips (the observed map is added)
+        seed: seed of all random streams
+        n_procs: number of worker processes
+        chunk_size: permutations per chunk (fixes the random streams, so
+            keep it constant to reproduce a run)
+        tfce: also compute TFCE and its FWE p values
+        E, H, connectivity: TFCE parameters
+
+    Output:
+        results: dict of in-mask voxel arrays: t, p (uncorrected), p_fwe
+            (max t), and with tfce: tfce, tfce_p_fwe (max tfce)
+    '''
+    from multiprocessing import Pool, RawArray
+    from tfce import HAVE_NUMBA, voxel_neighbours, tfce_in_mask
+
+    data = np.asarray(data, dtype=np.float32)
+    tfce_args = {'mask': mask, 'E': E, 'H': H, 'connectivity': connectivity}
+    # in-mask neighbours are found once and reused by every permutation
+    # (the union-find kernel, with numba)
+    neighbours = voxel_neighbours(mask, connectivity) if tfce and HAVE_NUMBA else None
+
+    sum_sq = np.sum(data.astype(np.float64) ** 2, axis=0)
+    t_obs = sign_flip_t(data, np.ones((1, data.shape[0])), sum_sq)[0]
+    tfce_obs = tfce_in_mask(t_obs, neighbours=neighbours, **tfce_args) if tfce else None
+
+    raw_data = RawArray('f', data.size)
+    np.frombuffer(raw_data, dtype=np.float32)[:] = data.ravel()
+
+    chunks = [min(chunk_size, n_perm - start) for start in range(0, n_perm, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    jobs = [(seed_seq, n_chunk, t_obs, tfce_obs) for (seed_seq, n_chunk) in zip(seeds, chunks)]
+
+    with Pool(n_procs, initializer=_init_worker,
+              initargs=(raw_data, data.shape, neighbours, tfce_args)) as pool:
+        # map keeps the chunk order, so the nulls do not depend on n_procs
+        chunk_results = pool.map(_permutation_chunk, jobs)
+
+    max_t = np.concatenate([res[0] for res in chunk_results])
+    count = np.sum([res[2] for res in chunk_results], axis=0)
+
+    results = {'t': t_obs,
+               'p': (1 + count) / (n_perm + 1),
+               'p_fwe': (1 + exceedance_counts(max_t, t_obs)) / (n_perm + 1)}
+
+    if tfce:
+        max_tfce = np.concatenate([res[1] for res in chunk_results])
+        results['tfce'] = tfce_obs
+        results['tfce_p_fwe'] = (1 + exceedance_counts(max_tfce, tfce_obs)) / (n_perm + 1)
+
+    return results
+
+#%%
+def run_sign_flip_tests(first_level_dir, subjects, contrasts, out_dir, n_perm=5000,
+                        seed=0, n_procs=4, tfce=True, cohort_dir=None):
+    '''
+    Sign-flip permutation tests of all contrasts, from a first-level sink
+
+    Input:
+        first_level_dir: e.g. Sink_resp/1stLevel
+        subjects: list of subject ids
+        contrasts: list of contrast names, e.g. ['con_0001', 'con_0002']
+        out_dir: e.g. Sink_resp/2ndLevel_permutation, one
+            _contrast_id_<contrast> folder per contrast
+        n_perm, seed, n_procs, tfce: see sign_flip_test
+        cohort_dir: optional cohort folder to read the data from (see
+            group_level.run_group_ttests)
+
+    Output:
+        out_files: dict, contrast: list of written maps
+    '''
+    import nibabel as nib
+    from group_level import load_contrast_stack, unmask
+
+    if cohort_dir is not None:
+        from cohort_tensor import build_cohort, load_cohort_stack
+
+        build_cohort(cohort_dir, first_level_dir, subjects, contrasts)
+        data, mask, affine = load_cohort_stack(cohort_dir, subjects, contrasts)
+    else:
+        con_files = [[os.path.join(first_level_dir, '_subject_id_%s' % sub, '%s.nii' % contrast)
+                      for sub in subjects]
+                     for contrast in contrasts]
+        data, mask, affine = load_contrast_stack(con_files)
+
+    out_files = {}
+    for (con_idx, contrast) in enumerate(contrasts):
+        results = sign_flip_test(data[con_idx], mask, n_perm=n_perm, seed=seed,
+                                 n_procs=n_procs, tfce=tfce)
+
+        maps = {'tstat1': results['t'],
+                'vox_p_tstat1': 1 - results['p'],
+                'vox_corrp_tstat1': 1 - results['p_fwe']}
+        if tfce:
+            maps['tfce_tstat1'] = results['tfce']
+            maps['tfce_corrp_tstat1'] = 1 - results['tfce_p_fwe']
+
+        con_dir = os.path.join(out_dir, '_contrast_id_%s' % contrast)
+        os.makedirs(con_dir, exist_ok=True)
+        out_files[contrast] = []
+        for (map_name, values) in maps.items():
+            out_file = os.path.join(con_dir, '%s.nii.gz' % map_name)
+            nib.Nifti1Image(unmask(values, mask, fill=0), affine).to_filename(out_file)
+            out_files[contrast].append(out_file)
+
+    return out_files
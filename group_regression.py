@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Group GLM of contrast maps on subject covariates
+
+Subject covariates come from the behavioural fits (par_*.csv: alpha, beta,
+val1..4) and post-scan ratings (rating_*.csv: rating1..4), one row per
+subject and domain. A covariate is named <column>_med or <column>_mon,
+e.g. 'beta_med' is the beta fit in the medical domain.
+
+All voxels of all contrasts are fitted with one pseudoinverse of the design
+(intercept + demeaned covariates). Inference on a covariate uses
+Freedman-Lane permutations: residuals of the model without the covariate
+are permuted across subjects and added back to its fitted values, then the
+full model is refitted. Max |t| over voxels gives two-sided FWE p values.
+Permutations run on a process pool with shared-memory data and seeded
+random streams per chunk, as group_permutation.py.
+"""
+import os
+import numpy as np
+
+# data shared with the worker processes, set by _init_worker
+_shared = {}
+
+#%%
+def load_covariates(csv_files, subjects, covariates):
+    '''
+    Subject covariates from the behavioural csv files
+
+    Input:
+        csv_files: list of csv files with columns id and is_med (e.g.
+            par_09300219.csv, rating_11082019.csv)
+        subjects: list of subject ids
+        covariates: list of names <column>_med or <column>_mon
+
+    Output:
+        table: pandas DataFrame, subject * covariate (nan when missing)
+    '''
+    import pandas as pd
+
+    tables = [pd.read_csv(csv_file) for csv_file in csv_files]
+    table = pd.DataFrame(index=subjects, columns=covariates, dtype=np.float64)
+
+    for covariate in covariates:
+        column, domain = covariate.rsplit('_', 1)
+        is_med = {'med': 1, 'mon': 0}[domain]
+        source = [t for t in tables if column in t.columns]
+        if not source:
+            raise ValueError('%s is not a column of %s' % (column, csv_files))
+
+        rows = source[0][source[0].is_med == is_med].drop_duplicates('id').set_index('id')
+        table[covariate] = rows[column].reindex(subjects).values
+
+    return table
+
+#%%
+def design_matrix(covariates):
+    '''
+    Intercept plus demeaned covariates
+
+    Input:
+        covariates: subject * covariate array
+
+    Output:
+        X: subject * (1 + covariate) design
+    '''
+    covariates = np.asarray(covariates, dtype=np.float64)
+
+    return np.column_stack([np.ones(len(covariates)), covariates - covariates.mean(axis=0)])
+
+#%%
+def glm_t(Y, X, pinv_X, contrast):
+    '''
+    t maps of one design contrast, all contrasts of the data at once
+
+    Input:
+        Y: data, contrast * subject * voxel
+        X: design, subject * regressor
+        pinv_X: pseudoinverse of X, regressor * subject
+        contrast: weights of the regressors
+
+    Output:
+        effect: contrast * voxel, contrast of the parameter estimates
+        t: contrast * voxel
+    '''
+    df = X.shape[0] - np.linalg.matrix_rank(X)
+    betas = np.matmul(pinv_X, Y)
+    residuals = Y - np.matmul(X, betas)
+    sigma2 = np.sum(residuals ** 2, axis=-2) / df
+
+    effect = np.einsum('p,cpv->cv', contrast, betas)
+    var_c = contrast @ pinv_X @ pinv_X.T @ contrast
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = effect / np.sqrt(sigma2 * var_c)
+
+    return effect, np.nan_to_num(t)
+
+#%%
+def _init_worker(raw_fitted, raw_residuals, shape, X, contrast):
+    _shared['fitted'] = np.frombuffer(raw_fitted, dtype=np.float32).reshape(shape)
+    _shared['residuals'] = np.frombuffer(raw_residuals, dtype=np.float32).reshape(shape)
+    _shared['X'] = X
+    _shared['pinv_X'] = np.linalg.pinv(X)
+    _shared['contrast'] = contrast
+
+#%%
+def _permutation_chunk(job):
+    '''
+    Freedman-Lane null statistics of one chunk of permutations
+
+    Output:
+        max_t: permutation * contrast, maximum |t| over voxels
+        count: contrast * voxel, permutations with |t| >= observed |t|
+    '''
+    seed_seq, n_perm, abs_t_obs = job
+    fitted, residuals = _shared['fitted'], _shared['residuals']
+    rng = np.random.default_rng(seed_seq)
+
+    max_t = np.zeros((n_perm, fitted.shape[0]))
+    count = np.zeros(abs_t_obs.shape, dtype=np.int64)
+    for perm in range(n_perm):
+        order = rng.permutation(fitted.shape[1])
+        # one contrast at a time keeps a single subject * voxel copy
+        for con_idx in range(fitted.shape[0]):
+            Y = fitted[con_idx:con_idx + 1] + residuals[con_idx:con_idx + 1, order]
+            abs_t = np.abs(glm_t(Y, _shared['X'], _shared['pinv_X'], _shared['contrast'])[1][0])
+            max_t[perm, con_idx] = abs_t.max()
+            count[con_idx] += abs_t >= abs_t_obs[con_idx]
+
+    return max_t, count
+
+#%%
+def group_regression(Y, covariates, covariate_idx, n_perm=0, seed=0, n_procs=4,
+                     chunk_size=100):
+    '''
+    Regress contrast values on subject covariates, with optional
+    Freedman-Lane permutation inference on one covariate
+
+    Input:
+        Y: contrast * subject * voxel data
+        covariates: subject * covariate array (no missing values)
+        covariate_idx: index of the covariate tested
+        n_perm: number of permutations (0: no inference)
+        seed, n_procs, chunk_size: as group_permutation.sign_flip_test
+
+    Output:
+        results: dict of contrast * voxel arrays: effect (slope), t, and
+            with permutations: p (uncorrected), p_fwe (max |t|), both
+            two-sided
+    '''
+    from multiprocessing import Pool, RawArray
+    from group_permutation import exceedance_counts
+
+    Y = np.asarray(Y, dtype=np.float32)
+    X = design_matrix(covariates)
+    pinv_X = np.linalg.pinv(X)
+    contrast = np.zeros(X.shape[1])
+    contrast[1 + covariate_idx] = 1
+
+    effect, t = glm_t(Y, X, pinv_X, contrast)
+    results = {'effect': effect, 't': t}
+    if not n_perm:
+        return results
+
+    # reduced model without the tested covariate
+    Z = np.delete(X, 1 + covariate_idx, axis=1)
+    fitted = np.matmul(Z @ np.linalg.pinv(Z), Y)
+    shared = []
+    for values in [fitted, Y - fitted]:
+        raw = RawArray('f', Y.size)
+        np.frombuffer(raw, dtype=np.float32)[:] = values.ravel()
+        shared.append(raw)
+
+    abs_t = np.abs(t)
+    chunks = [min(chunk_size, n_perm - start) for start in range(0, n_perm, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    jobs = [(seed_seq, n_chunk, abs_t) for (seed_seq, n_chunk) in zip(seeds, chunks)]
+
+    with Pool(n_procs, initializer=_init_worker,
+              initargs=(shared[0], shared[1], Y.shape, X, contrast)) as pool:
+        chunk_results = pool.map(_permutation_chunk, jobs)
+
+    max_t = np.concatenate([res[0] for res in chunk_results])
+    count = np.sum([res[1] for res in chunk_results], axis=0)
+
+    results['p'] = (1 + count) / (n_perm + 1)
+    # max |t| null of each contrast, counted by one sort each
+    count_fwe = np.array([exceedance_counts(max_t[:, con_idx], abs_t[con_idx])
+                          for con_idx in range(abs_t.shape[0])])
+    results['p_fwe'] = (1 + count_fwe) / (n_perm + 1)
+
+    return results
+
+#%%
+def run_group_regression(cohort_dir, subjects, contrasts, covariates, csv_files, out_dir,
+                         n_perm=0, seed=0, n_procs=4):
+    '''
+    Brain-behaviour maps of each covariate, from a cohort (cohort_tensor.py)
+
+    Subjects missing any covariate are left out. Each covariate is tested
+    in a model with all the covariates.
+
+    Input:
+        cohort_dir: e.g. Sink_resp/cohort
+        subjects: list of subject ids
+        contrasts: list of contrast names
+        covariates: list of covariate names, e.g. ['beta_med', 'beta_mon']
+        csv_files: behavioural csv files (see load_covariates)
+        out_dir: e.g. Sink_resp/2ndLevel_regression, written as
+            <covariate>/_contrast_id_<contrast>/<map>.nii.gz
+        n_perm, seed, n_procs: see group_regression
+
+    Output:
+        out_files: dict, covariate: list of written maps
+    '''
+    import nibabel as nib
+    from cohort_tensor import load_cohort_stack
+    from group_level import unmask
+
+    table = load_covariates(csv_files, subjects, covariates).dropna()
+    data, mask, affine = load_cohort_stack(cohort_dir, list(table.index), contrasts)
+
+    out_files = {}
+    for (cov_idx, covariate) in enumerate(covariates):
+        results = group_regression(data, table.values, cov_idx, n_perm=n_perm, seed=seed,
+                                   n_procs=n_procs)
+
+        maps = {'beta': results['effect'], 'tstat1': results['t']}
+        if n_perm:
+            maps['vox_p_tstat1'] = 1 - results['p']
+            maps['vox_corrp_tstat1'] = 1 - results['p_fwe']
+
+        out_files[covariate] = []
+        for (con_idx, contrast) in enumerate(contrasts):
+            con_dir = os.path.join(out_dir, covariate, '_contrast_id_%s' % contrast)
+            os.makedirs(con_dir, exist_ok=True)
+            for (map_name, values) in maps.items():
+                out_file = os.path.join(con_dir, '%s.nii.gz' % map_name)
+                nib.Nifti1Image(unmask(values[con_idx], mask, fill=0), affine).to_filename(out_file)
+                out_files[covariate].append(out_file)
+
+    return out_files
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Data sinks that link outputs into the sink instead of copying them
+
+LinkDataSink behaves like nipype's DataSink, but every file it would copy
+is reflinked or hardlinked when the work directory and the sink are on the
+same filesystem, and only copied otherwise (its _list_outputs is
+overridden, no nipype module is patched). LinkDerivativesDataSink keeps
+niworkflows' own hardlinking. Each sunk file is recorded with its sha256
+in sink_manifest.jsonl in the sink base directory.
+
+A hardlinked output shares its inode with the file in the work directory:
+a program rewriting that file in place also changes the sunk copy.
+"""
+import os
+import json
+import errno
+import shutil
+import hashlib
+
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import traits, isdefined
+
+# linux ioctl cloning a whole file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+#%%
+def reflink(src, dst):
+    '''
+    Copy-on-write clone of src to dst, raises OSError if not supported
+    '''
+    import fcntl
+
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (OSError, IOError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+#%%
+def link_or_copy(src, dst, mode='auto'):
+    '''
+    Put src at dst, without copying the data when possible
+
+    Input:
+        src: existing file
+        dst: destination path, replaced if it exists
+        mode: 'auto' (reflink, then hardlink, then copy), 'reflink',
+            'hardlink' or 'copy'
+
+    Output:
+        mode used: 'reflink', 'hardlink' or 'copy'
+    '''
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return 'hardlink'
+        os.remove(dst)
+
+    if mode in ('auto', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except (OSError, IOError, ImportError):
+            if mode == 'reflink':
+                raise
+
+    if mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as err:
+            # different filesystems, or links not allowed: copy instead
+            if mode == 'hardlink' or err.errno not in (errno.EXDEV, errno.EPERM,
+                                                       errno.EMLINK, errno.ENOTSUP):
+                raise
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+#%%
+def file_checksum(path, block_size=2 ** 20):
+    '''
+    sha256 of a file, read in blocks
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+#%%
+def write_manifest(base_directory, records, checksum=True):
+    '''
+    Append sunk files to <base_directory>/sink_manifest.jsonl
+
+    Input:
+        base_directory: sink base directory
+        records: list of (source, destination, mode)
+        checksum: add the sha256 of each destination file
+    '''
+    if not records:
+        return
+
+    lines = []
+    for (src, dst, mode) in records:
+        entry = {'destination': os.path.relpath(dst, base_directory),
+                 'source': src,
+                 'mode': mode,
+                 'size': os.path.getsize(dst)}
+        if checksum:
+            entry['sha256'] = file_checksum(dst)
+        lines.append(json.dumps(entry) + '\n')
+
+    os.makedirs(base_directory, exist_ok=True)
+    # one append per sink call, so concurrent nodes do not interleave lines
+    with open(os.path.join(base_directory, 'sink_manifest.jsonl'), 'a') as fobj:
+        fobj.write(''.join(lines))
+
+#%%
+def link_file(src, dst, mode='auto', related=True):
+    '''
+    Link one file into a sink, with its related files (.hdr/.img, .mat)
+    as nipype's copyfile
+
+    Output:
+        records: list of (source, destination, mode)
+    '''
+    from nipype.utils.filemanip import get_related_files
+
+    pairs = [(src, dst)]
+    if related:
+        pairs += [pair for pair in zip(get_related_files(src, include_this_file=False),
+                                       get_related_files(dst, include_this_file=False))
+                  if os.path.exists(pair[0])]
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    return [(src_file, dst_file, link_or_copy(src_file, dst_file, mode))
+            for (src_file, dst_file) in pairs]
+
+#%%
+def link_tree(src, dst, mode='auto'):
+    '''
+    Link every file of the folder src into dst, merged with what dst holds
+
+    Output:
+        records: list of (source, destination, mode)
+    '''
+    records = []
+    for (root, dirs, files) in os.walk(src):
+        out_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(out_root, exist_ok=True)
+        for name in files:
+            records += link_file(os.path.join(root, name), os.path.join(out_root, name),
+                                 mode, related=False)
+
+    return records
+
+#%% DataSink
+class LinkDataSinkInputSpec(nio.DataSinkInputSpec):
+    link_mode = traits.Enum('auto', 'reflink', 'hardlink', 'copy', usedefault=True,
+                            desc='how outputs are put into the sink')
+    checksum = traits.Bool(True, usedefault=True,
+                           desc='record the sha256 of sunk files in the manifest')
+
+
+class LinkDataSink(nio.DataSink):
+    '''
+    nio.DataSink linking outputs into base_directory, see link_or_copy
+
+    Destinations are DataSink's own (_get_dst, substitutions); only the
+    copy is replaced. Sinks to S3 or with local_copy are left to DataSink,
+    without manifest.
+    '''
+    input_spec = LinkDataSinkInputSpec
+
+    def _list_outputs(self):
+        from nipype.utils.filemanip import ensure_list
+
+        base_directory = self.inputs.base_directory
+        if not isdefined(base_directory):
+            base_directory = '.'
+        if base_directory.lower().startswith('s3://') or isdefined(self.inputs.local_copy):
+            return super(LinkDataSink, self)._list_outputs()
+
+        base_directory = os.path.abspath(base_directory)
+        out_dir = base_directory
+        if isdefined(self.inputs.container):
+            out_dir = os.path.join(out_dir, self.inputs.container)
+
+        records = []
+        out_files = []
+        for (key, files) in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            files = ensure_list(files if files else [])
+            if files and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            # folders of the key, '@' parts only name the input (as DataSink)
+            key_dir = os.path.join(out_dir, *[d for d in key.split('.') if not d.startswith('@')])
+
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, '')
+                dst = self._substitute(os.path.join(key_dir, self._get_dst(src)))
+
+                if os.path.isfile(src):
+                    records += link_file(src, dst, self.inputs.link_mode)
+                elif os.path.isdir(src):
+                    if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    records += link_tree(src, dst, self.inputs.link_mode)
+                else:
+                    continue
+                out_files.append(dst)
+
+        write_manifest(base_directory, records, self.inputs.checksum)
+
+        outputs = self.output_spec().get()
+        outputs['out_file'] = out_files
+
+        return outputs
+
+#%% DerivativesDataSink
+try:
+    from niworkflows.interfaces import bids as _niworkflows_bids
+except ImportError:
+    _niworkflows_bids = None
+
+if _niworkflows_bids is not None:
+
+    class LinkDerivativesDataSinkInputSpec(_niworkflows_bids.DerivativesDataSinkInputSpec):
+        checksum = traits.Bool(True, usedefault=True,
+                               desc='record the sha256 of sunk files in the manifest')
+
+
+    class LinkDerivativesDataSink(_niworkflows_bids.DerivativesDataSink):
+        '''
+        DerivativesDataSink recording its outputs in the sink manifest
+
+        DerivativesDataSink already hardlinks the files it does not rewrite
+        (new dtype or header); the manifest records each output as
+        'hardlink' when it shares the inode of its source, else 'copy'.
+        '''
+        input_spec = LinkDerivativesDataSinkInputSpec
+
+        def _run_interface(self, runtime):
+            from nipype.utils.filemanip import ensure_list
+
+            runtime = super(LinkDerivativesDataSink, self)._run_interface(runtime)
+
+            in_files = ensure_list(self.inputs.in_file)
+            out_files = ensure_list(self._results.get('out_file', []))
+            records = []
+            # merged inputs (one output for several files) have no single source
+            if len(in_files) == len(out_files):
+                records = [(src, dst, 'hardlink' if os.path.samefile(src, dst) else 'copy')
+                           for (src, dst) in zip(in_files, out_files)]
+
+            base_directory = runtime.cwd
+            if isdefined(self.inputs.base_directory) and self.inputs.base_directory:
+                base_directory = os.path.abspath(self.inputs.base_directory)
+            write_manifest(base_directory, records, self.inputs.checksum)
+
+            return runtime
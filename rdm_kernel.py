@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched RDM kernel for all ROIs and several distance metrics
+
+Every metric here is a function of the stims' Gram matrix within a ROI
+(G[i, j] = sum over the ROI's voxels of x_i * x_j), its voxel sums and its
+size. The Gram matrices of all ROIs come from one float64 sparse product:
+the ROI * voxel membership matrix times the stim-pair products of the
+gathered patterns (roi_atlas.RoiAtlas.gather). A new metric only needs
+the Gram matrices, not another pass over the images. For correlation the
+patterns are centred on their ROI mean before the products, so the Gram
+matrix does not lose the small pattern differences to cancellation (the
+RDMs equal 1 - np.corrcoef to rounding).
+
+Metrics:
+    correlation       1 - pearson r over voxels (as 1 - np.corrcoef)
+    cosine            1 - cosine similarity
+    euclidean         euclidean distance
+    mahalanobis_diag  euclidean distance of patterns divided by the noise
+                      sd of each voxel (diagonal noise covariance, e.g.
+                      ResMS); only with a noise estimate
+"""
+import numpy as np
+
+METRICS = ('correlation', 'cosine', 'euclidean', 'mahalanobis_diag')
+
+#%%
+def roi_gram(values, indptr, centre=False):
+    '''
+    Gram matrices and pattern sums of all ROIs
+
+    Input:
+        values: stim * voxel, ROIs' voxels one after another
+        indptr: ROI r holds voxels indptr[r]:indptr[r + 1]
+        centre: centre each pattern on its ROI mean first
+
+    Output:
+        gram: float64, roi * stim * stim
+        sums: float64, roi * stim, sum of each pattern over the ROI (before
+            centring)
+    '''
+    from scipy import sparse
+
+    values = np.asarray(values, dtype=np.float64)
+    n_stim, n_vox = values.shape
+    n_roi = len(indptr) - 1
+    sizes = np.diff(indptr)
+
+    membership = sparse.csr_matrix((np.ones(n_vox), np.arange(n_vox), indptr),
+                                   shape=(n_roi, n_vox))
+    sums = np.asarray(membership @ values.T)
+
+    if centre:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / sizes[:, None]
+        values = values - np.repeat(means, sizes, axis=0).T
+
+    # products of each stim pair (upper triangle with diagonal), pair * voxel
+    upper_i, upper_j = np.triu_indices(n_stim)
+    products = values[upper_i] * values[upper_j]
+
+    gram = np.zeros((n_roi, n_stim, n_stim))
+    gram_upper = np.asarray(membership @ products.T)
+    gram[:, upper_i, upper_j] = gram_upper
+    gram[:, upper_j, upper_i] = gram_upper
+
+    return gram, sums
+
+#%%
+def _gram_distance(gram):
+    # euclidean distance from a gram matrix
+    diag = np.einsum('...ii->...i', gram)
+    sq = diag[..., :, None] + diag[..., None, :] - 2 * gram
+
+    return np.sqrt(np.maximum(sq, 0))
+
+#%%
+def _gram_cosine(gram):
+    # 1 - cosine similarity from a gram matrix
+    diag = np.sqrt(np.einsum('...ii->...i', gram))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - gram / (diag[..., :, None] * diag[..., None, :])
+
+#%%
+def default_metrics(noise_var=None):
+    '''
+    Metrics computed when none are asked for: all of METRICS with a noise
+    estimate, without mahalanobis_diag otherwise
+    '''
+    return tuple(metric for metric in METRICS
+                 if metric != 'mahalanobis_diag' or noise_var is not None)
+
+#%%
+def rdm_matrices(values, indptr, metrics=None, noise_var=None):
+    '''
+    Full RDMs of all ROIs for several metrics
+
+    Input:
+        values: stim * voxel, ROIs' voxels one after another
+        indptr: ROI r holds voxels indptr[r]:indptr[r + 1]
+        metrics: names from METRICS, default default_metrics(noise_var)
+        noise_var: noise variance of each voxel (same layout as the columns
+            of values, e.g. ResMS), needed for mahalanobis_diag
+
+    Output:
+        rdms: float64, roi * metric * stim * stim (nan for an empty ROI)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    sizes = np.diff(indptr)
+    if metrics is None:
+        metrics = default_metrics(noise_var)
+
+    gram = None
+    n_stim = values.shape[0]
+    rdms = np.empty((len(sizes), len(metrics), n_stim, n_stim))
+    for (metric_idx, metric) in enumerate(metrics):
+        if metric == 'correlation':
+            rdms[:, metric_idx] = _gram_cosine(roi_gram(values, indptr, centre=True)[0])
+            continue
+        if metric == 'mahalanobis_diag':
+            if noise_var is None:
+                raise ValueError('mahalanobis_diag needs a noise estimate (noise_var, e.g. ResMS)')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weighted = np.nan_to_num(values / np.sqrt(np.asarray(noise_var, dtype=np.float64)))
+            rdms[:, metric_idx] = _gram_distance(roi_gram(weighted, indptr)[0])
+            continue
+        if metric not in METRICS:
+            raise ValueError('unknown metric %s, use one of %s' % (metric, METRICS))
+
+        if gram is None:
+            gram = roi_gram(values, indptr)[0]
+        if metric == 'cosine':
+            rdms[:, metric_idx] = _gram_cosine(gram)
+        elif metric == 'euclidean':
+            rdms[:, metric_idx] = _gram_distance(gram)
+
+    # distances of a pattern to itself
+    diag = np.arange(n_stim)
+    rdms[:, :, diag, diag] = 0
+    rdms[sizes == 0] = np.nan
+
+    return rdms
+
+#%%
+def rdm_tensor(values, indptr, metrics=None, noise_var=None):
+    '''
+    Condensed RDMs of all ROIs: float32, roi * metric * pair (120 pairs for
+    16 stims, order of rdm_utils.condensed); inputs as rdm_matrices
+    '''
+    from rdm_utils import condensed
+
+    return condensed(rdm_matrices(values, indptr, metrics, noise_var)).astype(np.float32)
+
+#%%
+def atlas_rdm_tensor(atlas, data, metrics=None, noise_var=None):
+    '''
+    Condensed RDMs of the ROIs of an atlas
+
+    Input:
+        atlas: roi_atlas.RoiAtlas
+        data: stim * x * y * z, or stim * voxel, on the atlas grid
+        metrics: names from METRICS, default default_metrics(noise_var)
+        noise_var: optional noise variance map (x * y * z, e.g. ResMS) on
+            the atlas grid
+
+    Output:
+        tensor: float32, roi * metric * pair, ROIs in atlas.names order
+    '''
+    if noise_var is not None:
+        noise_var = atlas.gather(noise_var)
+
+    return rdm_tensor(atlas.gather(data), atlas.indptr, metrics, noise_var)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RDM store: the ROI RDMs of a whole cohort in one file, no pickle
+
+compute_roi_rdm writes one roi_rdm.npy per subject (a pickled dict of full
+16 * 16 matrices) and roi_rdm_tensor.npz. The store packs one metric of
+all subjects into a single float32 [subject, roi, pair] array of condensed
+lower triangles (rdm_utils order), saved with np.save so it can be memory
+mapped, next to a json index of subjects, ROIs and stims.
+
+Layout (<sink>/rdm_store/):
+    rdm_store.npy     float32, subject * roi * pair
+    rdm_store.json    version, subjects, rois, stims, metric, pair order
+"""
+import os
+import json
+import numpy as np
+
+STORE_VERSION = 1
+
+#%%
+def read_rdm_meta(store_dir):
+    '''
+    Index of an RDM store: dict with version, subjects, rois, stims, metric
+    and pair_order
+    '''
+    with open(os.path.join(store_dir, 'rdm_store.json')) as f:
+        meta = json.load(f)
+
+    if meta['version'] > STORE_VERSION:
+        raise ValueError('RDM store %s has version %s, this reader knows up to %s'
+                         % (store_dir, meta['version'], STORE_VERSION))
+
+    return meta
+
+#%%
+def write_rdm_store(store_dir, rdms, subjects, rois, stims, metric='correlation'):
+    '''
+    Write an RDM store
+
+    Input:
+        store_dir: output folder
+        rdms: subject * roi * pair condensed RDMs
+        subjects: subject ids, in the order of the first axis
+        rois: ROI names, in the order of the second axis
+        stims: stim names, in the order of the RDM rows
+        metric: distance metric of the RDMs
+
+    Output:
+        meta: index of the store (see read_rdm_meta)
+    '''
+    rdms = np.asarray(rdms, dtype=np.float32)
+    n_stim = len(stims)
+    if rdms.shape != (len(subjects), len(rois), n_stim * (n_stim - 1) // 2):
+        raise ValueError('rdms of shape %s do not match %d subjects, %d rois and %d stims'
+                         % (rdms.shape, len(subjects), len(rois), n_stim))
+
+    meta = {'version': STORE_VERSION, 'subjects': [str(sub) for sub in subjects],
+            'rois': list(rois), 'stims': list(stims), 'metric': metric,
+            'pair_order': 'tril_row_major'}
+
+    os.makedirs(store_dir, exist_ok=True)
+    # write then rename, so a reader never sees a partial store
+    tmp_file = os.path.join(store_dir, 'rdm_store.tmp.npy')
+    np.save(tmp_file, rdms)
+    os.replace(tmp_file, os.path.join(store_dir, 'rdm_store.npy'))
+
+    tmp_file = os.path.join(store_dir, 'rdm_store.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp_file, os.path.join(store_dir, 'rdm_store.json'))
+
+    return meta
+
+#%%
+def read_subject_rdms(subject_dir, metric='correlation'):
+    '''
+    One subject's ROI RDMs from the output of compute_roi_rdm
+
+    roi_rdm_tensor.npz is read when it exists; older outputs only have the
+    pickled roi_rdm.npy dict (correlation RDMs, stims unnamed)
+
+    Output:
+        rdms: float32, roi * pair
+        rois: ROI names
+        stims: stim names, None for a pickled dict
+    '''
+    from rdm_utils import condensed
+
+    tensor_file = os.path.join(subject_dir, 'roi_rdm_tensor.npz')
+    if os.path.exists(tensor_file):
+        with np.load(tensor_file) as f:
+            metric_idx = list(f['metrics']).index(metric)
+            return (f['rdms'][:, metric_idx].astype(np.float32), list(f['rois']),
+                    list(f['stims']))
+
+    if metric != 'correlation':
+        raise ValueError('%s only holds correlation RDMs' % subject_dir)
+
+    rdm_dict = np.load(os.path.join(subject_dir, 'roi_rdm.npy'), allow_pickle=True).item()
+    rois = list(rdm_dict.keys())
+
+    return condensed(np.array([rdm_dict[roi] for roi in rois])).astype(np.float32), rois, None
+
+#%%
+def convert_rdm_outputs(rdm_dir, subjects, store_dir, stims=None, metric='correlation'):
+    '''
+    Pack the per-subject outputs of compute_roi_rdm into a store
+
+    Input:
+        rdm_dir: datasink folder with _subject_id_<sub>/ (e.g. .../rdm_new)
+        subjects: subject ids
+        store_dir: output folder
+        stims: stim names, needed when only pickled dicts exist
+        metric: distance metric
+
+    Output:
+        meta: index of the store
+    '''
+    rdms = []
+    for sub in subjects:
+        rdms_sub, rois_sub, stims_sub = read_subject_rdms(
+            os.path.join(rdm_dir, '_subject_id_%s' % sub), metric)
+
+        if not rdms:
+            rois = rois_sub
+        elif rois_sub != rois:
+            # align the ROIs of every subject to the first one
+            rdms_sub = rdms_sub[[rois_sub.index(roi) for roi in rois]]
+        if stims is None:
+            stims = stims_sub
+
+        rdms.append(rdms_sub)
+
+    if stims is None:
+        raise ValueError('no stim names in %s, pass stims' % rdm_dir)
+
+    return write_rdm_store(store_dir, np.stack(rdms), subjects, rois, stims, metric)
+
+#%%
+def load_rdm_store(store_dir, subjects=None, rois=None, mmap=True):
+    '''
+    RDMs of the whole cohort in one call
+
+    Input:
+        store_dir: store folder
+        subjects: subject ids to keep, default all
+        rois: ROI names to keep, default all
+        mmap: memory-map the file instead of reading it
+
+    Output:
+        rdms: float32, subject * roi * pair (read-only memmap when mmap and
+            no selection is made)
+        meta: index of the store, subjects and rois as returned
+    '''
+    meta = read_rdm_meta(store_dir)
+    rdms = np.load(os.path.join(store_dir, 'rdm_store.npy'), mmap_mode='r' if mmap else None)
+
+    if subjects is not None:
+        rdms = rdms[[meta['subjects'].index(str(sub)) for sub in subjects]]
+        meta['subjects'] = [str(sub) for sub in subjects]
+    if rois is not None:
+        rdms = rdms[:, [meta['rois'].index(roi) for roi in rois]]
+        meta['rois'] = list(rois)
+
+    return rdms, meta
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Helpers for condensed RDMs
+
+A condensed RDM is the lower triangle of the n * n matrix without the
+diagonal, row by row: (1, 0), (2, 0), (2, 1), (3, 0), ... as the vector of
+half_matrix, n * (n - 1) / 2 values (120 for the 16 stims). The triangle
+indices are computed once per n and shared by every call.
+"""
+from functools import lru_cache
+import numpy as np
+
+#%%
+@lru_cache(maxsize=None)
+def tril_index(n):
+    '''
+    Row and column indices of the condensed lower triangle of an n * n
+    matrix (np.tril_indices(n, -1)), computed once per n, read-only
+    '''
+    rows, cols = np.tril_indices(n, -1)
+    rows.setflags(write=False)
+    cols.setflags(write=False)
+
+    return rows, cols
+
+#%%
+@lru_cache(maxsize=None)
+def tril_mask(n):
+    '''
+    Boolean n * n mask of the condensed lower triangle, read-only
+    '''
+    mask = np.zeros((n, n), dtype=bool)
+    mask[tril_index(n)] = True
+    mask.setflags(write=False)
+
+    return mask
+
+#%%
+def condensed(rdms):
+    '''
+    Condensed lower triangles of a stack of RDMs
+
+    Input:
+        rdms: ... * n * n
+
+    Output:
+        vectors: ... * n(n-1)/2
+    '''
+    rdms = np.asarray(rdms)
+    rows, cols = tril_index(rdms.shape[-1])
+
+    return rdms[..., rows, cols]
+
+#%%
+def half_matrix(matrix):
+    '''
+    Take half of the RDMs, excluding diagonal
+
+    Input:
+        matrix: n * n, or a stack ... * n * n
+
+    Output:
+        half_matrix: matrix with the upper half and diagonal equal to nan
+        vector: condensed lower triangle (see condensed)
+    '''
+    matrix = np.asarray(matrix, dtype=np.float64)
+
+    return (np.where(tril_mask(matrix.shape[-1]), matrix, np.nan), condensed(matrix))
+
+#%%
+def squareform_lower(vectors, n=None):
+    '''
+    Full symmetric RDMs from condensed lower triangles (inverse of
+    condensed), zero diagonal
+
+    Input:
+        vectors: ... * n(n-1)/2
+        n: number of stims, default from the vector length
+
+    Output:
+        rdms: ... * n * n
+    '''
+    vectors = np.asarray(vectors)
+    if n is None:
+        n = int(round((1 + np.sqrt(1 + 8 * vectors.shape[-1])) / 2))
+    rows, cols = tril_index(n)
+
+    rdms = np.zeros(vectors.shape[:-1] + (n, n), dtype=vectors.dtype)
+    rdms[..., rows, cols] = vectors
+    rdms[..., cols, rows] = vectors
+
+    return rdms
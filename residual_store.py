@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pack SPM per-volume residual images into one compressed 4D store
+
+level1estimate writes one Res_XXXX.nii per volume. pack_residuals streams
+them, one volume at a time, into a single chunked, compressed HDF5 dataset
+and computes in the same pass what is needed downstream:
+    - ResMS (residual sum of squares / trRV, as SPM's ResMS.nii)
+    - smoothness (FWHM in voxels) and resel counts, with the streaming
+      sums of smoothness.py
+    - noise covariance of the residuals inside each ROI
+
+Store layout (Res.h5):
+    residuals           float32, volume * x * y * z, one chunk per volume
+    mask                uint8, x * y * z
+    affine              4 * 4
+    ResMS               float32, x * y * z
+    fwhm                FWHM along x, y, z in voxels (attrs: trRV, n_volumes)
+    resels              resel counts R0 to R3
+    roi_noise_cov/<roi> float64, roi voxels * roi voxels
+    roi_voxel_index/<roi> flat indices of the roi voxels
+    files               names of the packed residual images
+"""
+import os
+import numpy as np
+
+#%%
+def read_trrv(spm_mat_file):
+    '''
+    Effective residual degrees of freedom (SPM.xX.trRV) from SPM.mat
+    '''
+    import scipy.io as spio
+
+    spm = spio.loadmat(spm_mat_file, struct_as_record=False, squeeze_me=True)['SPM']
+
+    return float(spm.xX.trRV)
+
+#%%
+def pack_residuals(residual_images, mask_file, out_file, spm_mat_file=None,
+                   roi_masks=None, compression='gzip', compression_opts=4):
+    '''
+    Stream residual images into a compressed store, with summary statistics
+
+    Input:
+        residual_images: list of 3D residual images, in volume order
+        mask_file: analysis mask (SPM mask.nii)
+        out_file: path of the HDF5 store to write
+        spm_mat_file: SPM.mat, for trRV; without it ResMS uses the number
+            of volumes
+        roi_masks: optional dict, roi name: mask file, for ROI noise
+            covariances
+        compression: h5py compression filter
+        compression_opts: compression level
+
+    Output:
+        out_file: path of the store
+    '''
+    import h5py
+    import nibabel as nib
+    from smoothness import empty_sums, accumulate_sums, smoothness_from_sums, resel_counts
+
+    mask_img = nib.load(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    shape = mask.shape
+    n_vol = len(residual_images)
+
+    # voxel indices of each roi, on the residual grid
+    roi_index = {}
+    for (roi_name, roi_file) in (roi_masks or {}).items():
+        roi_img = nib.load(roi_file)
+        if roi_img.shape[:3] != shape or not np.allclose(roi_img.affine, mask_img.affine):
+            from nilearn.image import resample_to_img
+            roi_img = resample_to_img(roi_img, mask_img, interpolation='nearest')
+        roi_index[roi_name] = np.flatnonzero((np.asanyarray(roi_img.dataobj) > 0) & mask)
+
+    sum_sq, cross = empty_sums(shape)
+    roi_cross = {roi_name: np.zeros((len(idx), len(idx)))
+                 for (roi_name, idx) in roi_index.items()}
+
+    with h5py.File(out_file, 'w') as store:
+        residuals = store.create_dataset('residuals', shape=(n_vol,) + shape,
+                                         dtype=np.float32, chunks=(1,) + shape,
+                                         compression=compression,
+                                         compression_opts=compression_opts,
+                                         shuffle=True)
+        store.create_dataset('files', data=np.array([os.path.basename(f) for f in residual_images],
+                                                    dtype='S'))
+
+        for (vol_idx, res_file) in enumerate(residual_images):
+            vol = np.asanyarray(nib.load(res_file).dataobj).astype(np.float32)
+            vol[~mask | ~np.isfinite(vol)] = 0
+            residuals[vol_idx] = vol
+
+            vol = vol.astype(np.float64)
+            accumulate_sums(sum_sq, cross, vol[None], mask)
+
+            flat = vol.ravel()
+            for (roi_name, idx) in roi_index.items():
+                roi_cross[roi_name] += np.outer(flat[idx], flat[idx])
+
+        trrv = read_trrv(spm_mat_file) if spm_mat_file else float(n_vol)
+
+        store.create_dataset('mask', data=mask.astype(np.uint8))
+        store.create_dataset('affine', data=mask_img.affine)
+        store.create_dataset('ResMS', data=(sum_sq / trrv).astype(np.float32),
+                             compression=compression, compression_opts=compression_opts)
+
+        fwhm = smoothness_from_sums(sum_sq, cross, mask)
+        store.create_dataset('resels', data=resel_counts(mask, fwhm))
+        fwhm = store.create_dataset('fwhm', data=fwhm)
+        fwhm.attrs['trRV'] = trrv
+        fwhm.attrs['n_volumes'] = n_vol
+
+        roi_group = store.create_group('roi_noise_cov')
+        index_group = store.create_group('roi_voxel_index')
+        for (roi_name, acc) in roi_cross.items():
+            roi_group.create_dataset(roi_name, data=acc / trrv)
+            index_group.create_dataset(roi_name, data=roi_index[roi_name])
+
+    return out_file
+
+#%%
+def load_residual_summary(store_file):
+    '''
+    Summary statistics saved in a residual store
+
+    Output:
+        summary: dict with ResMS, fwhm, resels, trRV, affine, mask and
+            roi_noise_cov (dict, roi name: covariance matrix)
+    '''
+    import h5py
+
+    with h5py.File(store_file, 'r') as store:
+        summary = {'ResMS': store['ResMS'][()],
+                   'fwhm': store['fwhm'][()],
+                   'resels': store['resels'][()],
+                   'trRV': store['fwhm'].attrs['trRV'],
+                   'affine': store['affine'][()],
+                   'mask': store['mask'][()] > 0,
+                   'roi_noise_cov': {roi_name: store['roi_noise_cov'][roi_name][()]
+                                     for roi_name in store['roi_noise_cov']}}
+
+    return summary
+
+#%% Nipype function node
+def pack_residual_images(residual_images, mask_image, spm_mat_file, roi_masks=None):
+    '''
+    Function node packing level1estimate's residual_images into Res.h5
+
+    The Res_XXXX images are outputs of level1estimate and stay in its
+    working directory: deleting them would invalidate its cached results
+    and rerun the SPM estimation.
+
+    Input:
+        residual_images: Res_XXXX images from level1estimate
+        mask_image: mask image from level1estimate
+        spm_mat_file: SPM.mat from level1estimate
+        roi_masks: optional dict, roi name: mask file
+
+    Output:
+        residual_store: path of Res.h5
+    '''
+    from pathlib import Path
+    from residual_store import pack_residuals
+
+    residual_store = str(Path('Res.h5').resolve())
+    residual_images = sorted(residual_images)
+
+    pack_residuals(residual_images, mask_image, residual_store,
+                   spm_mat_file=spm_mat_file, roi_masks=roi_masks)
+
+    return residual_store
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled ROI atlas: all ROI masks as one sparse voxel -> ROI map
+
+The masks (possibly overlapping, e.g. the vmpfc conjunction and the Levy
+mPFC spheres) are compiled once, on the grid of the images to extract
+from, into CSR-style arrays: the flat voxel indices of all ROIs
+concatenated (indices), and each ROI's slice of them (indptr). Every ROI
+pattern of an image stack then comes from a single gather, and ROI means
+from one reduceat over it, so adding ROIs costs a few more indices.
+
+Masks are best passed as paths: with a cache folder, the voxel indices of a
+mask on a grid are saved as <cache_dir>/<key>.npy, keyed by the hash of
+the mask file and the grid (affine and shape), so a mask is resampled
+once per grid across subjects and runs.
+"""
+import os
+import hashlib
+import numpy as np
+
+#%%
+class RoiAtlas(object):
+    '''
+    ROI masks compiled on an image grid
+
+    Attributes:
+        names: ROI names, in order
+        indptr: ROI r holds indices[indptr[r]:indptr[r + 1]]
+        indices: flat (C order) voxel indices of all ROIs
+        shape: 3D shape of the grid
+        affine: affine of the grid
+    '''
+    def __init__(self, names, indptr, indices, shape, affine):
+        self.names = list(names)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.shape = tuple(shape)
+        self.affine = np.asarray(affine)
+
+    def __len__(self):
+        return len(self.names)
+
+    def sizes(self):
+        '''
+        Number of voxels of each ROI
+        '''
+        return np.diff(self.indptr)
+
+    def roi_index(self, name):
+        '''
+        Flat voxel indices of one ROI
+        '''
+        roi = self.names.index(name)
+        return self.indices[self.indptr[roi]:self.indptr[roi + 1]]
+
+    def _flat(self, data):
+        data = np.asarray(data)
+        if data.shape[-3:] == self.shape:
+            data = data.reshape(data.shape[:-3] + (-1,))
+
+        return data
+
+    def gather(self, data):
+        '''
+        Voxels of all ROIs in one gather
+
+        Input:
+            data: ... * x * y * z, or ... * voxel (flattened grid)
+
+        Output:
+            values: ... * len(indices), ROIs one after another
+        '''
+        return self._flat(data)[..., self.indices]
+
+    def patterns(self, data):
+        '''
+        Dict, ROI name: ... * roi voxel patterns (views of one gather)
+        '''
+        split = np.split(self.gather(data), self.indptr[1:-1], axis=-1)
+
+        return dict(zip(self.names, split))
+
+    def means(self, data):
+        '''
+        ROI means: ... * roi (nan for an empty ROI)
+        '''
+        values = self.gather(data)
+        sizes = self.sizes()
+        means = np.full(values.shape[:-1] + (len(self),), np.nan)
+
+        filled = sizes > 0
+        if filled.any():
+            sums = np.add.reduceat(values, self.indptr[:-1][filled], axis=-1)
+            means[..., filled] = sums / sizes[filled]
+
+        return means
+
+    def matrix(self):
+        '''
+        scipy.sparse CSR matrix, roi * voxel, ones where a voxel is in a ROI
+        '''
+        from scipy import sparse
+
+        return sparse.csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr),
+                                 shape=(len(self), int(np.prod(self.shape))))
+
+    def save(self, out_file):
+        '''
+        Save the atlas as an npz file
+        '''
+        np.savez(out_file, names=np.array(self.names), indptr=self.indptr,
+                 indices=self.indices, shape=np.array(self.shape), affine=self.affine)
+
+        return out_file
+
+    @classmethod
+    def load(cls, atlas_file):
+        '''
+        Atlas saved with save
+        '''
+        with np.load(atlas_file) as f:
+            return cls([str(name) for name in f['names']], f['indptr'], f['indices'],
+                       f['shape'], f['affine'])
+
+#%%
+def mask_voxel_index(mask, ref_img):
+    '''
+    Flat voxel indices of a mask on the grid of a reference image
+
+    Input:
+        mask: mask image or path; resampled (nearest) if its grid differs
+        ref_img: reference image or path
+
+    Output:
+        index: sorted flat (C order) voxel indices
+    '''
+    import nibabel as nib
+
+    if isinstance(mask, str):
+        mask = nib.load(mask)
+    if isinstance(ref_img, str):
+        ref_img = nib.load(ref_img)
+
+    if mask.shape[:3] != ref_img.shape[:3] or not np.allclose(mask.affine, ref_img.affine):
+        from nilearn.image import resample_to_img
+        mask = resample_to_img(mask, ref_img, interpolation='nearest')
+
+    return np.flatnonzero(np.asanyarray(mask.dataobj) > 0)
+
+#%%
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+#%%
+def cached_mask_voxel_index(mask_file, ref_img, cache_dir):
+    '''
+    mask_voxel_index through a persistent cache
+
+    Input:
+        mask_file: path of the mask
+        ref_img: reference image (grid of the voxel indices)
+        cache_dir: cache folder, created if needed
+
+    Output:
+        index: sorted flat (C order) voxel indices
+    '''
+    grid = np.round(np.asarray(ref_img.affine, dtype=np.float64), 6).tobytes()
+    grid += np.asarray(ref_img.shape[:3], dtype=np.int64).tobytes()
+    key = '%s_%s' % (_file_hash(mask_file), hashlib.sha1(grid).hexdigest())
+    cache_file = os.path.join(cache_dir, '%s.npy' % key)
+
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    index = mask_voxel_index(mask_file, ref_img)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, so parallel nodes never read a partial file
+    tmp_file = '%s.%d.npy' % (cache_file[:-4], os.getpid())
+    np.save(tmp_file, index)
+    os.replace(tmp_file, cache_file)
+
+    return index
+
+#%%
+def build_atlas(masks, ref_img, cache_dir=None):
+    '''
+    Compile ROI masks on the grid of a reference image
+
+    Input:
+        masks: dict, ROI name: mask path (or image)
+        ref_img: reference image or path (e.g. a subject's spmT map)
+        cache_dir: optional cache of voxel indices for masks given by path
+
+    Output:
+        atlas: RoiAtlas
+    '''
+    import nibabel as nib
+
+    if isinstance(ref_img, str):
+        ref_img = nib.load(ref_img)
+
+    names = list(masks.keys())
+    roi_indices = []
+    for name in names:
+        if cache_dir is not None and isinstance(masks[name], str):
+            roi_indices.append(cached_mask_voxel_index(masks[name], ref_img, cache_dir))
+        else:
+            roi_indices.append(mask_voxel_index(masks[name], ref_img))
+    indptr = np.concatenate([[0], np.cumsum([len(idx) for idx in roi_indices])])
+    indices = np.concatenate(roi_indices) if roi_indices else np.zeros(0, dtype=np.int64)
+
+    return RoiAtlas(names, indptr, indices, ref_img.shape[:3], ref_img.affine)
@@ -12,9 +12,9 @@ import numpy as np
 
 import nipype.interfaces.utility as util  # utility
 from nipype import Node, Workflow, MapNode
-import nibabel as nib
 import nipype.pipeline.engine as pe  # pypeline engine
 import nipype.interfaces.io as nio  # Data i/o
+from link_sink import LinkDataSink # links outputs into the sink instead of copying
 
 #%%
 base_root = '/home/rj299/scratch60/mdm_analysis/'
@@ -48,54 +48,68 @@ selectfiles = MapNode(nio.SelectFiles(templates,
                       name="selectfiles",
                       iterfield = ['con_id'])
         
+# ResMS of each subject, the noise variance of each voxel for the mahalanobis rdms
+selectresms = Node(nio.SelectFiles({'resms': os.path.join(out_root, 'imaging', 'Sink_resp_rsa_nosmooth', '1stLevel', '_subject_id_{subject_id}', 'ResMS.nii')},
+                   base_directory=out_root),
+                   name="selectresms")
+
 #%% Compute ROI RDM function
     
 def compute_roi_rdm(in_file,
                     stims,
-                    all_masks):
+                    all_masks,
+                    cache_dir=None,
+                    noise_file=None):
     
     from pathlib import Path
-    from nilearn.input_data import NiftiMasker
     import nibabel as nib
     import numpy as np
+    from roi_atlas import build_atlas
+    from rdm_kernel import default_metrics, rdm_matrices
+    from rdm_utils import condensed
     
     rdm_out = Path('roi_rdm.npy').resolve()
-    stim_num = len(stims)
+    rdm_tensor = Path('roi_rdm_tensor.npz').resolve()
+    
+    # load every stim's map once, stim * voxel
+    spmt_first = nib.load(in_file[0])
+    spmt_allstims = np.stack([np.asanyarray(nib.load(spmt_file).dataobj, dtype=np.float64).ravel()
+                              for spmt_file in in_file])
+    
+    # all rois compiled on the maps' grid, their patterns from a single gather
+    atlas = build_atlas(all_masks, spmt_first, cache_dir=cache_dir)
+    
+    # noise variance of each voxel (ResMS) for the mahalanobis metric, 
+    # which is left out without it
+    noise_var = None
+    if noise_file:
+        noise_var = atlas.gather(np.asanyarray(nib.load(noise_file).dataobj, 
+                                               dtype=np.float64).ravel())
+    metrics = default_metrics(noise_var)
     
-    # dictionary to store rdms for all rois
+    # rdms of all rois and metrics from the rois' gram matrices, 
+    # roi * metric * stim * stim
+    rdms = rdm_matrices(atlas.gather(spmt_allstims), atlas.indptr, metrics, noise_var)
+    
+    # dictionary to store the correlation rdms of all rois
     rdm_dict = {}
     
-    # loop over all rois
-    for mask_name in all_masks.keys():
-        mask = all_masks[mask_name]
-        masker = NiftiMasker(mask_img=mask)
-        
-        # initiate matrix
-        spmt_allstims_roi= np.zeros((stim_num, np.sum(mask.get_data()).astype(int)))
-            
-        for (stim_idx, spmt_file) in enumerate(in_file):
-            spmt = nib.load(spmt_file)
-          
-            # get each condition's beta
-            spmt_roi = masker.fit_transform(spmt)
-            spmt_allstims_roi[stim_idx, :] = spmt_roi
-        
-        # create rdm
-        rdm_roi = 1 - np.corrcoef(spmt_allstims_roi)
-        
-        rdm_dict[mask_name] = rdm_roi
+    for (roi_idx, mask_name) in enumerate(atlas.names):
+        rdm_dict[mask_name] = rdms[roi_idx, metrics.index('correlation')]
         
     # save    
     np.save(rdm_out, rdm_dict)
+    np.savez(rdm_tensor, rdms=condensed(rdms).astype(np.float32), rois=np.array(atlas.names), 
+             metrics=np.array(metrics), stims=np.array([stims[key] for key in sorted(stims)]))
     
-    return str(rdm_out)
+    return str(rdm_out), str(rdm_tensor)
 
 
 #%% Compute ROI node
 get_roi_rdm = Node(util.Function(
-    input_names=['in_file', 'stims', 'all_masks'],
+    input_names=['in_file', 'stims', 'all_masks', 'cache_dir', 'noise_file'],
     function=compute_roi_rdm, 
-    output_names=['rdm_out']),
+    output_names=['rdm_out', 'rdm_tensor']),
     name='get_roi_rdm',
     )    
     
@@ -162,8 +176,9 @@ maskfiles = {'vmpfc': maskfile_vmpfc,
              'levy_risk_mpfc': maskfile_levy_risk_mpfc
              }
 
-# roi inputs are loaded images
-get_roi_rdm.inputs.all_masks = {key_name: nib.load(maskfiles[key_name]) for key_name in maskfiles.keys()}
+# roi inputs are mask paths; their voxel indices on the maps' grid are cached
+get_roi_rdm.inputs.all_masks = maskfiles
+get_roi_rdm.inputs.cache_dir = os.path.join(output_dir, 'roi_index_cache')
 
 #%%
 wf_roirdm = Workflow(name="roi_rdm", base_dir=work_dir)
@@ -171,16 +186,19 @@ wf_roirdm = Workflow(name="roi_rdm", base_dir=work_dir)
 wf_roirdm.connect([
         (infosource, selectfiles, [('subject_id', 'subject_id'), ('con_id', 'con_id')]),
         (selectfiles, get_roi_rdm, [('contrast', 'in_file')]),
+        (infosource, selectresms, [('subject_id', 'subject_id')]),
+        (selectresms, get_roi_rdm, [('resms', 'noise_file')]),
         ])
 
 #%%
 # Datasink
-datasink_rdm = Node(nio.DataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
+datasink_rdm = Node(LinkDataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
                                          name="datasink_rdm")
                        
 
 wf_roirdm.connect([
-        (get_roi_rdm, datasink_rdm, [('rdm_out', 'rdm_new.@rdm')]),
+        (get_roi_rdm, datasink_rdm, [('rdm_out', 'rdm_new.@rdm'),
+                                     ('rdm_tensor', 'rdm_new.@rdm_tensor')]),
         ])
 #%% 
 wf_roirdm.run('Linear', plugin_args = {'n_procs': 1})    
@@ -16,11 +16,14 @@ import os
 import numpy as np
 import pandas as pd
 #import scipy.io
-from scipy import stats
 #import scipy.spatial.distance as sp_distance
 
 import nibabel as nib
 
+from searchlight import run_searchlight
+from rdm_store import convert_rdm_outputs, load_rdm_store, read_rdm_meta
+from rdm_utils import half_matrix
+
 import matplotlib.pyplot as plt
 import matplotlib.pylab as pylab
 
@@ -86,75 +89,35 @@ def ambig_utility(sub_id, par, p, a, obj_val, domain, model):
         
     return sv, ref_sv
 
-#%%
-def half_matrix(matrix):
-    ''' Take half of the correlation matrix, excluding diagnoal
-    Input:
-        matrix
-    
-    Output:
-        half_matrix: matrix with the upper half and diagnal equals to nan
-        vector: vector of the half matrix, without nan
-    '''
-    import copy
-    
-    half_matrix = copy.deepcopy(matrix)
-    
-    vector = []
-    for i in range(half_matrix.shape[0]):
-        for j in range(half_matrix.shape[1]):
-            if i-j <= 0:
-                half_matrix[i,j] = np.nan
-            else:
-                vector.append(half_matrix[i,j])
-    
-    return half_matrix, np.array(vector)
-
 #%%
 # calculate spearman correlation between rdm and model rdm
 # for each model, each roi, each subject
 
-def compare_with_model(subjects, roi_names, mod_rdm_vector, out_fig):
+def compare_with_model(rdms, subjects, roi_names, mod_rdm_vector, out_fig):
+    '''
+    Input:
+        rdms: condensed rdms from the rdm store, subject * roi * pair, in the
+            order of subjects and roi_names
+        mod_rdm_vector: dictionary of model vectors; for sv and rating, model 
+            rdm is different for each individual, a dictionary of subjects
+    '''
+    from rsa_stats import compare_rdms, stack_models
     
     mod_names = list(mod_rdm_vector.keys())
     
+    # the whole subject * roi * model table at once
+    rho, pvalue = compare_rdms(rdms, stack_models(mod_rdm_vector, subjects))
+    
     spearman_r = {roi_name: {} for roi_name in roi_names} # each model is an entry in this dictionary
     spearman_p = {roi_name: {} for roi_name in roi_names}
-        
-#     spearman_r = {'domain': {}, 'uncertainty': {}, 'value': {}}
-#     spearman_p = {'domain': {}, 'uncertainty': {}, 'value': {}}
 
     for (roi_idx, roi_name) in enumerate(roi_names):
         
-        # each roi is an entry in the dictionary
-        spearman_r_roi = {mod_name: [] for mod_name in mod_names} # spearman's rho
-        spearman_p_roi = {mod_name: [] for mod_name in mod_names} # p values
-
-    #     spearman_r_mod = {'vmpfc': [], 'vstr': []}
-    #     spearman_p_mod = {'vmpfc': [], 'vstr': []}
-
-        for sub in subjects:
-            roi_rdm_obj = np.load('/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_rsa_nosmooth/rdm_new/_subject_id_%s/roi_rdm.npy' %sub,
-                   allow_pickle = True)
-
-            # get dictionary type
-            roi_rdm = roi_rdm_obj.item()
-
-    #         roi_names = list(roi_rdm.keys())
-
-            for (mod_idx, mod_name) in enumerate(mod_names):
-                # spearman bween model rdm and individual rdm, using only half of matrix
-                rdm_half, rdm_vector = half_matrix(roi_rdm[roi_name])
-                
-                if mod_name == 'sv' or mod_name == 'rating':
-                    # for these two models, model rdm is different for each individual
-                    # thus, mode_rdm_vector[mod_name] is a dictionary, each subject in an item
-                    rho, pvalue = stats.spearmanr(rdm_vector, mod_rdm_vector[mod_name][sub])
-                else:
-                    rho, pvalue = stats.spearmanr(rdm_vector, mod_rdm_vector[mod_name])
-
-                spearman_r_roi[mod_name].append(rho)
-                spearman_p_roi[mod_name].append(pvalue)
+        # each roi is an entry in the dictionary, a list of subjects for each model
+        spearman_r_roi = {mod_name: list(rho[:, roi_idx, mod_idx]) 
+                          for (mod_idx, mod_name) in enumerate(mod_names)} # spearman's rho
+        spearman_p_roi = {mod_name: list(pvalue[:, roi_idx, mod_idx]) 
+                          for (mod_idx, mod_name) in enumerate(mod_names)} # p values
 
         spearman_r[roi_name] = spearman_r_roi
         spearman_p[roi_name] = spearman_p_roi
@@ -196,66 +159,39 @@ def plot_r_hist(r, out_fig, save = False):
 # each permutation: calculate spearman correlation between rdm and model rdm
 # do this for each model, each roi
 
-def permutation_test(subjects, roi_names, mod_rdm_vector, out_fig,
-                    iter_num = 1000, perm_num = 100):
-    
-    import numpy as np
-#     iter_num number of iteration
-#     perm_num number of subjects (permutation)
+def permutation_test(rdms, subjects, roi_names, mod_rdm_vector, out_fig,
+                    iter_num = 1000, perm_num = 100, seed = 0, n_procs = 8, 
+                    checkpoint_file = None):
+    '''
+    Input:
+        rdms: condensed rdms from the rdm store, subject * roi * pair, in the
+            order of subjects and roi_names
+        iter_num: number of iterations (null samples)
+        perm_num: number of subjects drawn in each iteration; each drawn rdm
+            has its stims (rows and columns together) permuted
+        seed: seed of the random streams; the same seed gives the same null 
+            for any n_procs
+        n_procs: number of worker processes (cpus of the job)
+        checkpoint_file: finished chunks of permutations are appended to this
+            file; rerunning with the same file (e.g. after a slurm timeout) 
+            resumes from the last finished chunk
+    '''
+    from rsa_permutation import permutation_null
+    from rsa_stats import stack_models
     
     mod_names = list(mod_rdm_vector.keys())
     
+    # iteration * roi * model, all in memory
+    null, _ = permutation_null(rdms, stack_models(mod_rdm_vector, subjects), 
+                               n_iter = iter_num, n_draw = perm_num, seed = seed, 
+                               n_procs = n_procs, checkpoint_file = checkpoint_file)
+    
     r_perm = {roi_name: {} for roi_name in roi_names}
 
-    # each model
     for (roi_idx, roi_name) in enumerate(roi_names):
 
-        r_perm_roi = {mod_name: [] for mod_name in mod_names}
-
-        # each ROI
-        for (mod_idx, mod_name) in enumerate(mod_names):
-
-            for iter_idx in range(iter_num): 
-
-                rho_perm = []
-
-                for perm_idx in range(perm_num):
-                    # randomly select a subject
-                    sub = np.random.choice(subjects)
-                    roi_rdm_obj = np.load('/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_rsa_nosmooth/rdm_new/_subject_id_%s/roi_rdm.npy' %sub,
-                                          allow_pickle = True)
-
-                    # get dictionary type
-                    roi_rdm = roi_rdm_obj.item()
-
-                    rdm_perm = roi_rdm[roi_name]
-
-                    # shuffle columns
-                    np.random.shuffle(rdm_perm)
-
-    #                 # permute columns of matrix
-    #                 columns = list(range(roi_rdm[roi_name].shape(0)))
-
-    #                 columns_perm = np.random.permutation(columns)
-
-    #                 rdm_perm = np.argsort(columns_perm)
-
-                    # spearman bween model rdm and individual rdm, half matrix
-                    _, rdm_vector_perm = half_matrix(rdm_perm)
-
-    #                 rdm_vector_perm = np.random.permutation(rdm_vector)
-                    if mod_name == 'sv' or mod_name == 'rating':
-                    # for these two models, model rdm is different for each individual
-                    # thus, mode_rdm_vector[mod_name] is a dictionary, each subject in an item
-                        rho_i, pvalue_i = stats.spearmanr(rdm_vector_perm, mod_rdm_vector[mod_name][sub])
-                    else:
-                        rho_i, pvalue_i = stats.spearmanr(rdm_vector_perm, mod_rdm_vector[mod_name])
-
-                    rho_perm.append(rho_i)
-
-                r_perm_roi[mod_name].append(np.median(rho_perm))
-                
-                print('Model %s, ROI %s, iteration %s finished' %(mod_name, roi_name, iter_idx+1))
+        r_perm_roi = {mod_name: list(null[:, roi_idx, mod_idx]) 
+                      for (mod_idx, mod_name) in enumerate(mod_names)}
 
         r_perm[roi_name] = r_perm_roi
         
@@ -324,12 +260,18 @@ subjects = [2073, 2550, 2582, 2583, 2584, 2585, 2588, 2592,
             2658, 2659, 2660, 2661, 2662, 2663, 2664, 2665, 2666]
 
 #%%
+# rdms of all subjects and rois, packed once from the per-subject outputs
+rdm_dir = os.path.join(out_root, 'imaging', 'Sink_resp_rsa_nosmooth', 'rdm_new')
+rdm_store_dir = os.path.join(out_root, 'imaging', 'Sink_resp_rsa_nosmooth', 'rdm_store')
+
+if (not os.path.exists(os.path.join(rdm_store_dir, 'rdm_store.json')) or 
+    read_rdm_meta(rdm_store_dir)['subjects'] != [str(sub) for sub in subjects]):
+    convert_rdm_outputs(rdm_dir, subjects, rdm_store_dir, 
+                        stims = [stims[key] for key in sorted(stims.keys())])
+
 # all rois' names
-sub = 2654
-roi_rdm_obj = np.load('/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_rsa_nosmooth/rdm_new/_subject_id_%s/roi_rdm.npy' %sub,
-              allow_pickle = True)
-roi_rdm = roi_rdm_obj.item()
-roi_names_all = list(roi_rdm.keys())
+rdms, rdm_meta = load_rdm_store(rdm_store_dir, subjects = subjects)
+roi_names_all = rdm_meta['rois']
 
 print('All names of ROIs:')
 for roi_name in roi_names_all:
@@ -519,12 +461,11 @@ vector = [{}, {}]
 
 for (mod_idx, mod_rdm) in enumerate([mod_rdm_sv, mod_rdm_rating]):
     
-    mod_rdm_vector_mod = {}
-    
-    for sub in mod_rdm.keys():
-        _, mod_rdm_vector_mod[sub] = half_matrix(mod_rdm[sub])
+    # all subjects' matrices as one stack
+    subs = list(mod_rdm.keys())
+    _, mod_rdm_vector_mod = half_matrix(np.stack([mod_rdm[sub] for sub in subs]))
         
-    vector[mod_idx] = mod_rdm_vector_mod            
+    vector[mod_idx] = dict(zip(subs, mod_rdm_vector_mod))
 
 mod_rdm_vector_individual = {}
 mod_rdm_vector_individual['sv'] = vector[0]
@@ -552,15 +493,50 @@ mod_rdm_vector['rating'] = mod_rdm_vector_individual['rating']
 # save this dictionary
 #np.save(os.path.join(out_fig, 'model_rdms_vector.npy'), mod_rdm_vector)
 
+#%% searchlight: each sphere's rdm compared with the models, one rho map per model
+do_searchlight = False
+searchlight_radius = 6 # mm
+
+if do_searchlight:
+    for sub in subjects:
+        spmt_files = [os.path.join(data_root, '_subject_id_%s' % sub, 'spmT_00%s.nii' % stim_id)
+                      for stim_id in sorted(stims.keys())]
+        
+        # subject specific models (sv, rating) are dictionaries of subjects
+        models_sub = {mod_name: (mod_rdm_vector[mod_name][sub] 
+                                 if isinstance(mod_rdm_vector[mod_name], dict) 
+                                 else mod_rdm_vector[mod_name])
+                      for mod_name in mod_rdm_vector.keys()}
+        
+        run_searchlight(spmt_files, models_sub, 
+                        os.path.join(out_root, 'imaging', 'Sink_resp_rsa_nosmooth', 
+                                     'searchlight', '_subject_id_%s' % sub),
+                        radius=searchlight_radius, n_procs=8, 
+                        cache_dir=os.path.join(out_root, 'imaging', 'searchlight_cache'))
+
 #%% plot ROI rdms correlation with model spearman rho distribution
 #roi_names = ['vmpfc', 'vstr']
 roi_names = roi_names_all
+rdms_roi = rdms[:, [roi_names_all.index(roi_name) for roi_name in roi_names]]
 
 # plot correlation with model
-spearman_r, spearman_p = compare_with_model(subjects, roi_names, mod_rdm_vector, out_fig)
+spearman_r, spearman_p = compare_with_model(rdms_roi, subjects, roi_names, mod_rdm_vector, out_fig)
 
 plot_r_hist(spearman_r, out_fig, True)
 
+#%% bootstrap confidence intervals of the group median rho (resampling subjects)
+from rsa_stats import compare_rdms, stack_models
+from rsa_bootstrap import bootstrap_table
+
+mod_names = list(mod_rdm_vector.keys())
+rho_all, _ = compare_rdms(rdms_roi, stack_models(mod_rdm_vector, subjects))
+boot_table = bootstrap_table(rho_all, n_boot = 10000, seed = 0)
+
+boot_table = pd.DataFrame({key: value.ravel() for (key, value) in boot_table.items()}, 
+                          index = pd.MultiIndex.from_product([roi_names, mod_names], 
+                                                             names = ['roi', 'model']))
+boot_table.to_csv(os.path.join(out_fig, 'bootstrap_median_ci.csv'))
+
 #%%
 
 # load saved 
@@ -569,12 +545,30 @@ plot_r_hist(spearman_r, out_fig, True)
 #                                          allow_pickle = True)
 #spearman_r_temp = spearman_r_obj.item()
 
+#%% 
+# sequential permutation p values: each roi * model cell stops once h null 
+# medians exceed the observed one, only borderline cells get the full budget
+from rsa_permutation import sequential_p
+
+perm_sequential = False # adaptive mode only; the stats notebook reads the full nulls
+
+if perm_sequential:
+    p_seq, n_perm_used, r_obs, _ = sequential_p(rdms_roi, stack_models(mod_rdm_vector, subjects), 
+                                                h = 10, n_max = 10000, seed = 0, n_procs = 8)
+    
+    pd.DataFrame({'r_median': r_obs.ravel(), 'p': p_seq.ravel(), 'n_perm': n_perm_used.ravel()}, 
+                 index = pd.MultiIndex.from_product([roi_names, mod_names], 
+                                                    names = ['roi', 'model'])
+                 ).to_csv(os.path.join(out_fig, 'perm_p_sequential.csv'))
+
 #%%
-# plot null distribution from permutation 
-spearman_r_perm = permutation_test(subjects, roi_names, mod_rdm_vector, out_fig,
-                                   iter_num = 2000, # default: 1000
-#                                   perm_num = 50 # default: 100
-                                  )
+# plot null distribution from permutation (full null of every cell)
+if not perm_sequential:
+    spearman_r_perm = permutation_test(rdms_roi, subjects, roi_names, mod_rdm_vector, out_fig,
+                                       iter_num = 2000, # default: 1000
+#                                       perm_num = 50 # default: 100
+                                       checkpoint_file = os.path.join(out_fig, 'perm_null_checkpoint.dat')
+                                      )
 
 #%%
 # load saved 
@@ -588,5 +582,6 @@ spearman_r_perm = permutation_test(subjects, roi_names, mod_rdm_vector, out_fig,
 #    r_perm = r_perm_obj.item()
 #    spearman_r_perm[roi_name] = r_perm
     
-plot_permutation_null(spearman_r_perm, out_fig, 0.05, True)
+if not perm_sequential:
+    plot_permutation_null(spearman_r_perm, out_fig, 0.05, True)
     
\ No newline at end of file
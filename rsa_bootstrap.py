@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Subject bootstrap of the group median RDM-model rho
+
+All resamples are one [n_boot, n_subject] index matrix. The subject rhos
+of every ROI and model (rsa_stats.compare_rdms) are sorted once; the
+median of a resample is then an order statistic of the sorted values,
+found from the cumulated counts of the drawn subjects, in batches of
+resamples (no copy of the resampled rhos, no np.median call). Intervals are percentile or BCa (bias
+corrected and accelerated, acceleration from the jackknife).
+"""
+import numpy as np
+
+#%%
+def bootstrap_indices(rng, n_boot, n_sub):
+    '''
+    Subject indices of n_boot resamples with replacement: n_boot * n_sub
+    '''
+    return rng.integers(n_sub, size=(n_boot, n_sub))
+
+#%%
+def bootstrap_medians(rho, n_boot=10000, seed=None, batch_size=1000):
+    '''
+    Medians of subject resamples
+
+    Input:
+        rho: subject * ... (e.g. subject * roi * model)
+        n_boot: number of resamples
+        seed: seed of the random generator
+        batch_size: resamples reduced at once
+
+    Output:
+        medians: n_boot * ...
+    '''
+    rho = np.asarray(rho, dtype=np.float64)
+    n_sub = rho.shape[0]
+    index = bootstrap_indices(np.random.default_rng(seed), n_boot, n_sub)
+
+    # cell (roi, model) * subject, sorted once per cell (nan last)
+    cells = rho.reshape(n_sub, -1).T
+    order = np.argsort(cells, axis=1, kind='stable')
+    sorted_cells = np.take_along_axis(cells, order, axis=1)
+    cell_idx = np.arange(len(cells))
+    n_valid = np.sum(~np.isnan(sorted_cells), axis=1)
+    # positions of the middle order statistics (one for odd n_sub)
+    low_pos, high_pos = (n_sub - 1) // 2, n_sub // 2
+
+    medians = np.empty((n_boot, len(cells)))
+    for start in range(0, n_boot, batch_size):
+        batch = index[start:start + batch_size]
+        n_batch = len(batch)
+        # times each subject is drawn, then cumulated in each cell's order
+        counts = np.bincount((batch + n_sub * np.arange(n_batch)[:, None]).ravel(),
+                             minlength=n_batch * n_sub).reshape(n_batch, n_sub)
+        cum = np.cumsum(counts.astype(np.int16)[:, order], axis=-1, dtype=np.int16)
+
+        low = np.sum(cum <= low_pos, axis=-1)
+        high = low if low_pos == high_pos else np.sum(cum <= high_pos, axis=-1)
+        batch_medians = (sorted_cells[cell_idx, low] + sorted_cells[cell_idx, high]) / 2
+
+        # as np.median, nan when a nan subject is drawn
+        has_nan = cum[:, cell_idx, np.maximum(n_valid - 1, 0)] < n_sub
+        medians[start:start + n_batch] = np.where(has_nan, np.nan, batch_medians)
+
+    return medians.reshape((n_boot,) + rho.shape[1:])
+
+#%%
+def jackknife_medians(rho):
+    '''
+    Leave-one-subject-out medians: subject * ...
+    '''
+    rho = np.asarray(rho, dtype=np.float64)
+    n_sub = rho.shape[0]
+    # row i holds every subject but i
+    leave_out = np.array([np.delete(np.arange(n_sub), sub) for sub in range(n_sub)])
+    rho_last = np.ascontiguousarray(np.moveaxis(rho, 0, -1))
+
+    return np.moveaxis(np.median(rho_last[..., leave_out], axis=-1), -1, 0)
+
+#%%
+def _quantiles(values, q):
+    # quantiles along axis 0 at a different level q for every cell (linear
+    # interpolation, as np.quantile)
+    values = np.sort(values, axis=0)
+    valid = np.isfinite(q)
+    pos = np.clip(np.where(valid, q, 0), 0, 1) * (values.shape[0] - 1)
+    low = np.floor(pos).astype(int)
+    high = np.minimum(low + 1, values.shape[0] - 1)
+
+    value_low = np.take_along_axis(values, low[None], axis=0)[0]
+    value_high = np.take_along_axis(values, high[None], axis=0)[0]
+
+    return np.where(valid, value_low + (pos - low) * (value_high - value_low), np.nan)
+
+#%%
+def percentile_interval(medians, alpha=0.05):
+    '''
+    Percentile interval of bootstrap medians (n_boot * ...): low, high
+    '''
+    return tuple(np.quantile(medians, [alpha / 2, 1 - alpha / 2], axis=0))
+
+#%%
+def bca_interval(rho, medians, alpha=0.05):
+    '''
+    BCa interval of the median
+
+    Input:
+        rho: subject * ..., the observed values
+        medians: n_boot * ..., bootstrap medians of rho
+        alpha: 1 - coverage
+
+    Output:
+        low, high: ...
+    '''
+    from scipy import stats
+
+    rho = np.asarray(rho, dtype=np.float64)
+    observed = np.median(rho, axis=0)
+
+    # bias: share of bootstrap medians below the observed one (ties count half)
+    below = np.mean(medians < observed, axis=0) + np.mean(medians == observed, axis=0) / 2
+    z0 = stats.norm.ppf(below)
+
+    # acceleration from the jackknife
+    jack = jackknife_medians(rho)
+    diff = jack.mean(axis=0) - jack
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accel = np.sum(diff ** 3, axis=0) / (6 * np.sum(diff ** 2, axis=0) ** 1.5)
+    accel = np.nan_to_num(accel)
+
+    bounds = []
+    for z_alpha in stats.norm.ppf([alpha / 2, 1 - alpha / 2]):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q = stats.norm.cdf(z0 + (z0 + z_alpha) / (1 - accel * (z0 + z_alpha)))
+        bounds.append(_quantiles(medians, q))
+
+    return tuple(bounds)
+
+#%%
+def bootstrap_table(rho, n_boot=10000, alpha=0.05, seed=None):
+    '''
+    Group median of every cell with its quartiles and bootstrap intervals
+
+    Input:
+        rho: subject * roi * model
+        n_boot: number of resamples
+        alpha: 1 - coverage of the intervals
+        seed: seed of the random generator
+
+    Output:
+        table: dict of roi * model arrays: median, q_25, q_75 (over
+            subjects), ci_low, ci_high (percentile), bca_low, bca_high
+    '''
+    rho = np.asarray(rho, dtype=np.float64)
+    medians = bootstrap_medians(rho, n_boot, seed)
+
+    table = {'median': np.median(rho, axis=0)}
+    table['q_25'], table['q_75'] = np.quantile(rho, [.25, .75], axis=0)
+    table['ci_low'], table['ci_high'] = percentile_interval(medians, alpha)
+    table['bca_low'], table['bca_high'] = bca_interval(rho, medians, alpha)
+
+    return table
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stimulus-label permutation nulls of RDM-model rank correlations, in memory
+
+The null of roi_rdm_compare_with_model.permutation_test: each iteration
+draws n_draw subjects (with replacement), relabels the stims of each
+drawn RDM with a random permutation and keeps the median spearman rho
+with the model RDMs. Relabelling the stims permutes rows and columns of
+the RDM jointly; on a condensed vector it is a gather by a pair index
+array, and since ranks follow the values, the z-scored ranks of the
+permuted vector are the permuted z-scored ranks. So every RDM and model
+is ranked once, and rhos of whole batches of draws are one einsum.
+
+Null samples are split in fixed chunks, each with its own random stream
+spawned from one seed, and run on a process pool reading the ranks from
+shared memory: the same seed gives the same null for any number of
+processes.
+
+sequential_p stops each ROI * model cell once it has h null samples at
+least as extreme as the observed median (Besag & Clifford 1991), so only
+borderline cells run up to the full budget. Its null samples permute the
+stims of every subject once and take the median over all subjects, the
+same statistic as the observed one.
+
+With a checkpoint file, every finished chunk is appended to it (chunk
+index, number of samples, null values) and a resumed run only computes
+the chunks not in the file. The seed, chunk size and a hash of the
+inputs are kept in <checkpoint>.json, so a chunk's random stream is the
+same when it is run again.
+"""
+import os
+import json
+import hashlib
+from functools import lru_cache
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+# data shared with the worker processes, set by _init_worker
+_shared = {}
+
+#%%
+@lru_cache(maxsize=None)
+def pair_index(n):
+    '''
+    Condensed index (rdm_utils order) of every stim pair: n * n, symmetric,
+    -1 on the diagonal, read-only
+    '''
+    from rdm_utils import tril_index
+
+    rows, cols = tril_index(n)
+    index = np.full((n, n), -1, dtype=np.int64)
+    index[rows, cols] = np.arange(len(rows))
+    index[cols, rows] = np.arange(len(rows))
+    index.setflags(write=False)
+
+    return index
+
+#%%
+def random_permutations(rng, n_perm, n):
+    '''
+    n_perm independent random permutations of n stims: n_perm * n
+    '''
+    return np.argsort(rng.random((n_perm, n)), axis=1)
+
+#%%
+def permuted_pairs(perms):
+    '''
+    Gather indices that relabel condensed RDMs
+
+    Input:
+        perms: permutations of the stims, ... * n
+
+    Output:
+        index: ... * n(n-1)/2; vector[index] is the condensed RDM with
+            rows and columns permuted by perms
+    '''
+    from rdm_utils import tril_index
+
+    perms = np.asarray(perms)
+    rows, cols = tril_index(perms.shape[-1])
+
+    return pair_index(perms.shape[-1])[perms[..., rows], perms[..., cols]]
+
+#%%
+def rank_inputs(rdms, models):
+    '''
+    Rank RDMs and models once for the permutation engine
+
+    Input:
+        rdms: condensed RDMs, subject * roi * pair
+        models: dict, model name: pair, or subject * pair for models
+            specific to each subject (see rsa_stats.stack_models)
+
+    Output:
+        rdm_ranks: z-scored ranks, subject * roi * pair
+        model_ranks: z-scored ranks, model * subject * pair
+        model_names: models in the order of model_ranks
+    '''
+    from rsa_stats import zscore_ranks
+
+    rdms = np.asarray(rdms)
+    n_sub = rdms.shape[0]
+    model_names = list(models.keys())
+
+    model_ranks = np.empty((len(model_names), n_sub, rdms.shape[2]))
+    for (model_idx, name) in enumerate(model_names):
+        # a model shared by all subjects is broadcast to every subject
+        model_ranks[model_idx] = zscore_ranks(models[name])
+
+    return zscore_ranks(rdms), model_ranks, model_names
+
+#%%
+def null_medians(rdm_ranks, model_ranks, rng, n_iter, n_draw=100, batch_iter=10):
+    '''
+    Median rhos of permuted RDMs of randomly drawn subjects
+
+    Input:
+        rdm_ranks, model_ranks: from rank_inputs
+        rng: numpy Generator
+        n_iter: number of null samples
+        n_draw: subjects drawn (with replacement) per null sample; None:
+            every subject once, the statistic of the observed median
+        batch_iter: null samples computed per batch (memory: batch_iter *
+            n_draw * roi * pair doubles)
+
+    Output:
+        null: n_iter * roi * model
+    '''
+    n_sub, n_roi, n_pair = rdm_ranks.shape
+    n_stim = int(round((1 + np.sqrt(1 + 8 * n_pair)) / 2))
+    roi_idx = np.arange(n_roi)[None, :, None]
+
+    null = np.empty((n_iter, n_roi, model_ranks.shape[0]))
+    for start in range(0, n_iter, batch_iter):
+        stop = min(start + batch_iter, n_iter)
+
+        if n_draw is None:
+            n_per = n_sub
+            sub = np.tile(np.arange(n_sub), stop - start)
+        else:
+            n_per = n_draw
+            sub = rng.integers(n_sub, size=(stop - start) * n_draw)
+        n_batch = len(sub)
+
+        index = permuted_pairs(random_permutations(rng, n_batch, n_stim))
+
+        # draw * roi * pair, the permuted ranks of each drawn subject
+        ranks = rdm_ranks[sub[:, None, None], roi_idx, index[:, None, :]]
+        rho = np.einsum('drp,mdp->drm', ranks, model_ranks[:, sub])
+
+        null[start:stop] = np.median(rho.reshape((stop - start, n_per) + rho.shape[1:]), axis=1)
+
+    return null
+
+#%%
+def _init_worker(raw_rdm, rdm_shape, raw_model, model_shape, n_draw, batch_iter):
+    _shared['rdm_ranks'] = np.frombuffer(raw_rdm, dtype=np.float64).reshape(rdm_shape)
+    _shared['model_ranks'] = np.frombuffer(raw_model, dtype=np.float64).reshape(model_shape)
+    _shared['n_draw'] = n_draw
+    _shared['batch_iter'] = batch_iter
+
+#%%
+def _null_chunk(job):
+    '''
+    Null samples of one chunk
+
+    Input:
+        job: (seed sequence of the chunk, number of null samples), optionally
+            followed by the indices of the rois and of the models to run
+
+    Output:
+        null: n_iter * roi * model
+    '''
+    seed_seq, n_iter = job[:2]
+    rdm_ranks, model_ranks = _shared['rdm_ranks'], _shared['model_ranks']
+    if len(job) > 2:
+        # only these rois and models; the random draws do not depend on them
+        rdm_ranks, model_ranks = rdm_ranks[:, job[2]], model_ranks[job[3]]
+
+    return null_medians(rdm_ranks, model_ranks, np.random.default_rng(seed_seq), n_iter,
+                        _shared['n_draw'], _shared['batch_iter'])
+
+#%%
+def null_jobs(n_iter, seed=0, chunk_size=50):
+    '''
+    Fixed chunks of a run: list of (seed sequence, number of null samples),
+    one independent random stream per chunk
+    '''
+    chunks = [min(chunk_size, n_iter - start) for start in range(0, n_iter, chunk_size)]
+
+    return list(zip(np.random.SeedSequence(seed).spawn(len(chunks)), chunks))
+
+#%%
+def _shared_array(values):
+    # float64 copy of values in shared memory
+    from multiprocessing import RawArray
+
+    raw = RawArray('d', values.size)
+    np.frombuffer(raw, dtype=np.float64)[:] = values.ravel()
+
+    return raw
+
+#%%
+def _open_checkpoint(checkpoint_file, run):
+    '''
+    Index of a checkpointed run: written for a new run, checked against run
+    for a resumed one
+
+    Output:
+        run: the run as stored (seed filled in)
+    '''
+    meta_file = checkpoint_file + '.json'
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            stored = json.load(f)
+        if run['seed'] is None:
+            run['seed'] = stored['seed']
+        if stored != run:
+            raise ValueError('checkpoint %s belongs to another run (%s), remove it or '
+                             'change the file' % (checkpoint_file, stored))
+        return stored
+
+    if run['seed'] is None:
+        # keep the entropy, so the run can be resumed
+        run['seed'] = np.random.SeedSequence().entropy
+
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_file)), exist_ok=True)
+    # write then rename, so a resumed run never reads a partial index
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(run, f, indent=1)
+    os.replace(meta_file + '.tmp', meta_file)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    return run
+
+#%%
+def read_checkpoint(checkpoint_file, n_cell):
+    '''
+    Completed chunks of a checkpoint file; a partial last record (a job
+    killed while writing) is cut off
+
+    Input:
+        checkpoint_file: append-only file of chunk records
+        n_cell: roi * model values per null sample
+
+    Output:
+        done: dict, chunk index: null of the chunk (n_iter * n_cell)
+    '''
+    done = {}
+    if not os.path.exists(checkpoint_file):
+        return done
+
+    with open(checkpoint_file, 'r+b') as f:
+        end = 0
+        while True:
+            head = f.read(16)
+            if len(head) < 16:
+                break
+            chunk_idx, n_iter = np.frombuffer(head, dtype=np.int64)
+            body = f.read(8 * n_iter * n_cell)
+            if len(body) < 8 * n_iter * n_cell:
+                break
+            done[int(chunk_idx)] = np.frombuffer(body, dtype=np.float64).reshape(n_iter, n_cell)
+            end = f.tell()
+        f.truncate(end)
+
+    return done
+
+#%%
+def _append_chunk(f, chunk_idx, null):
+    # one record: chunk index, number of samples, values; on disk before
+    # the next chunk is written
+    f.write(np.array([chunk_idx, len(null)], dtype=np.int64).tobytes())
+    f.write(np.ascontiguousarray(null, dtype=np.float64).tobytes())
+    f.flush()
+    os.fsync(f.fileno())
+
+#%%
+def _input_hash(*arrays):
+    sha = hashlib.sha1()
+    for values in arrays:
+        sha.update(np.asarray(values.shape, dtype=np.int64).tobytes())
+        sha.update(np.ascontiguousarray(values).tobytes())
+
+    return sha.hexdigest()
+
+#%%
+def permutation_null(rdms, models, n_iter=1000, n_draw=100, seed=0, n_procs=1, chunk_size=50,
+                     batch_iter=10, checkpoint_file=None):
+    '''
+    Permutation null of the median RDM-model rho of every ROI and model
+
+    Input:
+        rdms: condensed RDMs, subject * roi * pair
+        models: dict, model name: pair, or subject * pair
+        n_iter: number of null samples
+        n_draw: subjects drawn per null sample (None: every subject once)
+        seed: seed of all random streams (None: fresh entropy, kept in the
+            checkpoint)
+        n_procs: number of worker processes (1: run in this process)
+        chunk_size: null samples per chunk (fixes the random streams, so
+            keep it constant to reproduce a run)
+        batch_iter: null samples per batch within a chunk
+        checkpoint_file: optional append-only file of finished chunks; an
+            interrupted run called again with the same file resumes
+
+    Output:
+        null: n_iter * roi * model
+        model_names: models in the order of the last axis
+    '''
+    from multiprocessing import Pool
+
+    rdm_ranks, model_ranks, model_names = rank_inputs(rdms, models)
+    n_roi, n_model = rdm_ranks.shape[1], model_ranks.shape[0]
+
+    done = {}
+    if checkpoint_file is not None:
+        run = _open_checkpoint(checkpoint_file,
+                               {'version': CHECKPOINT_VERSION, 'seed': seed, 'n_iter': n_iter,
+                                'n_draw': n_draw, 'chunk_size': chunk_size,
+                                'model_names': model_names,
+                                'inputs': _input_hash(rdm_ranks, model_ranks)})
+        seed = run['seed']
+        done = read_checkpoint(checkpoint_file, n_roi * n_model)
+
+    jobs = null_jobs(n_iter, seed, chunk_size)
+    pending = [chunk_idx for chunk_idx in range(len(jobs)) if chunk_idx not in done]
+
+    if pending:
+        initargs = (_shared_array(rdm_ranks), rdm_ranks.shape, _shared_array(model_ranks),
+                    model_ranks.shape, n_draw, batch_iter)
+        pool = None
+        if n_procs == 1:
+            _init_worker(*initargs)
+            results = map(_null_chunk, [jobs[chunk_idx] for chunk_idx in pending])
+        else:
+            pool = Pool(n_procs, initializer=_init_worker, initargs=initargs)
+            # imap keeps the chunk order, so the null does not depend on n_procs
+            results = pool.imap(_null_chunk, [jobs[chunk_idx] for chunk_idx in pending])
+
+        f = open(checkpoint_file, 'ab') if checkpoint_file is not None else None
+        try:
+            for (chunk_idx, null_chunk) in zip(pending, results):
+                done[chunk_idx] = null_chunk.reshape(len(null_chunk), -1)
+                if f is not None:
+                    _append_chunk(f, chunk_idx, done[chunk_idx])
+        finally:
+            if f is not None:
+                f.close()
+            if pool is not None:
+                pool.terminate()
+
+    null = np.concatenate([done[chunk_idx] for chunk_idx in range(len(jobs))])
+
+    return null.reshape(n_iter, n_roi, n_model), model_names
+
+#%%
+def sequential_p(rdms, models, h=10, n_max=10000, seed=0, n_procs=1, chunk_size=50,
+                 batch_iter=10, tail='right'):
+    '''
+    Sequential permutation p-values of the median RDM-model rho (Besag &
+    Clifford 1991)
+
+    A null sample is the observed statistic under relabelled stims: the
+    stims of every subject's RDM are permuted once and the median is taken
+    over all subjects (no resampling of subjects, so the null has the
+    spread of the observed median). Samples are drawn chunk by chunk as in
+    permutation_null; a cell stops once h null medians are at least as
+    extreme as the observed one, after L samples, with p = h / L. A cell
+    that reaches n_max with g < h gets p = (g + 1) / (n_max + 1). The draws
+    of a chunk do not depend on which cells are still running, so p is the
+    same for any n_procs.
+
+    Input:
+        rdms: condensed RDMs, subject * roi * pair
+        models: dict, model name: pair, or subject * pair
+        h: exceedances that stop a cell (larger h: less variable p near the
+            significance level, more samples)
+        n_max: most null samples per cell
+        seed, n_procs, chunk_size, batch_iter: see permutation_null
+        tail: 'right' (null >= observed) or 'two-sided' (|null| >= |observed|)
+
+    Output:
+        p: roi * model
+        n_used: null samples drawn for each cell
+        observed: observed median rho, roi * model
+        model_names: models in the order of the last axis
+    '''
+    from multiprocessing import Pool
+
+    if tail not in ('right', 'two-sided'):
+        raise ValueError("tail must be 'right' or 'two-sided', not %s" % tail)
+
+    rdm_ranks, model_ranks, model_names = rank_inputs(rdms, models)
+    observed = np.median(np.einsum('srp,msp->srm', rdm_ranks, model_ranks), axis=0)
+    if tail == 'two-sided':
+        observed = np.abs(observed)
+
+    shape = observed.shape
+    count = np.zeros(shape, dtype=np.int64)
+    n_used = np.zeros(shape, dtype=np.int64)
+    # cells without an observed rho (e.g. an empty roi) are not run
+    done = np.isnan(observed)
+
+    jobs = null_jobs(n_max, seed, chunk_size)
+    # every subject once per null sample, as in the observed median
+    initargs = (_shared_array(rdm_ranks), rdm_ranks.shape, _shared_array(model_ranks),
+                model_ranks.shape, None, batch_iter)
+    pool = None
+    if n_procs == 1:
+        _init_worker(*initargs)
+    else:
+        pool = Pool(n_procs, initializer=_init_worker, initargs=initargs)
+
+    try:
+        next_chunk = 0
+        while not done.all() and next_chunk < len(jobs):
+            # rois and models with a running cell; one chunk per process
+            roi_idx = np.flatnonzero(~done.all(axis=1))
+            model_idx = np.flatnonzero(~done.all(axis=0))
+            round_jobs = [job + (roi_idx, model_idx)
+                          for job in jobs[next_chunk:next_chunk + max(n_procs, 1)]]
+            next_chunk += len(round_jobs)
+
+            results = (map(_null_chunk, round_jobs) if pool is None
+                       else pool.map(_null_chunk, round_jobs))
+
+            cells = np.ix_(roi_idx, model_idx)
+            for null in results:
+                if tail == 'two-sided':
+                    null = np.abs(null)
+                running = ~done[cells]
+                cum_count = count[cells] + np.cumsum(null >= observed[cells], axis=0)
+
+                # sample at which a cell reaches h exceedances
+                hit = cum_count >= h
+                stop = running & hit.any(axis=0)
+                first = np.argmax(hit, axis=0)
+
+                n_used[cells] = np.where(stop, n_used[cells] + first + 1,
+                                         np.where(running, n_used[cells] + len(null), n_used[cells]))
+                count[cells] = np.where(stop, h, np.where(running, cum_count[-1], count[cells]))
+                done[cells] = done[cells] | stop
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(count >= h, h / n_used, (count + 1) / (n_used + 1))
+    p[np.isnan(observed)] = np.nan
+
+    return p, n_used, observed, model_names
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rank correlation of RDMs with model RDMs, vectorized
+
+Spearman rho is the pearson r of ranks: every RDM and model vector is
+ranked once (average ties, as scipy.stats.rankdata), the ranks are
+z-scored, and all rhos come from matrix products. compare_rdms gives the
+whole subject * ROI * model table of roi_rdm_compare_with_model.py at
+once.
+"""
+import numpy as np
+
+#%%
+def rank_average(x):
+    '''
+    Ranks along the last axis, ties get their average rank (1-based)
+
+    Input:
+        x: ... * n
+
+    Output:
+        ranks: float64, ... * n
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[-1]
+
+    order = np.argsort(x, axis=-1, kind='mergesort')
+    sorted_x = np.take_along_axis(x, order, axis=-1)
+
+    # first and last sorted position of each value's tie group
+    starts = np.ones(x.shape, dtype=bool)
+    starts[..., 1:] = sorted_x[..., 1:] != sorted_x[..., :-1]
+    ends = np.ones(x.shape, dtype=bool)
+    ends[..., :-1] = starts[..., 1:]
+
+    pos = np.broadcast_to(np.arange(n), x.shape)
+    first = np.maximum.accumulate(np.where(starts, pos, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(ends, pos, n - 1), axis=-1), axis=-1),
+                   axis=-1)
+
+    ranks = np.empty(x.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=-1)
+
+    return ranks
+
+#%%
+def zscore_ranks(x):
+    '''
+    Ranks along the last axis, centred and scaled to unit norm, so that the
+    dot product of two rows is their spearman rho; rows with nan or
+    constant values give nan
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    ranks = rank_average(x)
+    ranks -= ranks.mean(axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ranks /= np.sqrt(np.sum(ranks ** 2, axis=-1, keepdims=True))
+    ranks[np.isnan(x).any(axis=-1)] = np.nan
+
+    return ranks
+
+#%%
+def spearman_rows(x, models):
+    '''
+    Spearman rho of every row of x with every model vector
+
+    Input:
+        x: ... * n (e.g. centre * pair RDM vectors)
+        models: model * n
+
+    Output:
+        rho: ... * model
+    '''
+    return zscore_ranks(x) @ zscore_ranks(models).T
+
+#%%
+def spearman_p(rho, n):
+    '''
+    Two-sided p-values of spearman rhos from n pairs, t approximation with
+    n - 2 degrees of freedom (as scipy.stats.spearmanr)
+    '''
+    from scipy import stats
+
+    # rounding can put a perfect rho just outside [-1, 1]
+    rho = np.clip(np.asarray(rho, dtype=np.float64), -1, 1)
+    df = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = rho * np.sqrt(df / ((1 - rho) * (1 + rho)))
+
+    return 2 * stats.t.sf(np.abs(t), df)
+
+#%%
+def compare_rdms(rdms, models):
+    '''
+    Spearman rho of every subject's ROI RDMs with every model RDM
+
+    All RDMs and models are ranked once; models shared by all subjects
+    take one matrix product [subject * roi, pair] x [pair, model], models
+    specific to each subject (sv, rating) a batched diagonal product
+
+    Input:
+        rdms: condensed RDMs, subject * roi * pair
+        models: dict, model name: condensed model RDM, pair (same for all
+            subjects) or subject * pair (subjects in the order of rdms)
+
+    Output:
+        rho: subject * roi * model, models in the order of the dict
+        p: two-sided p-values of rho (spearman_p)
+    '''
+    rdms = np.asarray(rdms)
+    n_sub, n_roi, n_pair = rdms.shape
+    rdm_ranks = zscore_ranks(rdms)
+
+    model_names = list(models.keys())
+    shared = [name for name in model_names if np.ndim(models[name]) == 1]
+    individual = [name for name in model_names if np.ndim(models[name]) == 2]
+
+    rho = np.empty((n_sub, n_roi, len(model_names)))
+    if shared:
+        shared_ranks = zscore_ranks(np.array([models[name] for name in shared]))
+        rho[:, :, [model_names.index(name) for name in shared]] = (
+            rdm_ranks.reshape(-1, n_pair) @ shared_ranks.T).reshape(n_sub, n_roi, -1)
+    if individual:
+        # model * subject * pair
+        individual_ranks = zscore_ranks(np.array([models[name] for name in individual]))
+        rho[:, :, [model_names.index(name) for name in individual]] = np.einsum(
+            'srp,msp->srm', rdm_ranks, individual_ranks)
+
+    return rho, spearman_p(rho, n_pair)
+
+#%%
+def stack_models(models, subjects):
+    '''
+    Model RDMs as arrays for compare_rdms: subject-specific models given as
+    dicts (subject: condensed RDM) become subject * pair arrays in the order
+    of subjects, other models are kept as they are
+    '''
+    return {name: (np.array([model[sub] for sub in subjects]) if isinstance(model, dict)
+                   else np.asarray(model))
+            for (name, model) in models.items()}
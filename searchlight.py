@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Searchlight RSA
+
+Every in-mask voxel's sphere (radius in mm) is found once with a KD-tree
+and kept as a sparse adjacency (CSR: the in-mask voxels of all spheres
+concatenated, indptr per centre), cached on disk per mask and radius.
+Centres are processed in chunks on a process pool: a chunk's spheres are
+gathered from the stacked spmT patterns in one go, their 16 * 16
+correlation RDMs come from the batched kernel (rdm_kernel.py, each sphere
+taken as a ROI), and spearman rho with every model RDM is one matrix
+product (rsa_stats.py). One rho map per model is written per subject.
+"""
+import os
+import hashlib
+import numpy as np
+
+# data shared with the worker processes, set by _init_worker
+_shared = {}
+
+#%%
+def sphere_adjacency(mask, affine, radius):
+    '''
+    Sphere neighbourhood of every in-mask voxel
+
+    Input:
+        mask: boolean 3D mask
+        affine: affine of the mask
+        radius: sphere radius in mm
+
+    Output:
+        indptr: centre c's sphere is indices[indptr[c]:indptr[c + 1]]
+        indices: in-mask voxel indices (order of np.flatnonzero(mask))
+    '''
+    from scipy.spatial import cKDTree
+
+    coords = np.argwhere(mask) @ affine[:3, :3].T + affine[:3, 3]
+    tree = cKDTree(coords)
+    spheres = tree.query_ball_point(coords, radius)
+
+    indptr = np.concatenate([[0], np.cumsum([len(sphere) for sphere in spheres])])
+    indices = np.concatenate([np.sort(sphere) for sphere in spheres]).astype(np.int32)
+
+    return indptr, indices
+
+#%%
+def cached_sphere_adjacency(mask, affine, radius, cache_dir=None):
+    '''
+    sphere_adjacency through a cache in cache_dir, keyed by the hash of the
+    mask, its affine and the radius
+    '''
+    if cache_dir is None:
+        return sphere_adjacency(mask, affine, radius)
+
+    sha = hashlib.sha1()
+    sha.update(np.packbits(mask).tobytes())
+    sha.update(np.asarray(mask.shape, dtype=np.int64).tobytes())
+    sha.update(np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+    cache_file = os.path.join(cache_dir, 'sphere_%s_r%g.npz' % (sha.hexdigest(), radius))
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as f:
+            return f['indptr'], f['indices']
+
+    indptr, indices = sphere_adjacency(mask, affine, radius)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, so parallel jobs never read a partial file
+    tmp_file = '%s.%d.npz' % (cache_file[:-4], os.getpid())
+    np.savez(tmp_file, indptr=indptr, indices=indices)
+    os.replace(tmp_file, cache_file)
+
+    return indptr, indices
+
+#%%
+def _init_worker(patterns, indptr, indices, model_ranks):
+    _shared['patterns'] = patterns
+    _shared['indptr'] = indptr
+    _shared['indices'] = indices
+    _shared['model_ranks'] = model_ranks
+
+#%%
+def _searchlight_chunk(job):
+    '''
+    Model rhos of the centres start:stop
+
+    Output:
+        rho: centre * model
+    '''
+    from rdm_kernel import rdm_tensor
+    from rsa_stats import zscore_ranks
+
+    start, stop = job
+    indptr = _shared['indptr']
+    lo, hi = indptr[start], indptr[stop]
+
+    values = _shared['patterns'][:, _shared['indices'][lo:hi]]
+    rdms = rdm_tensor(values, indptr[start:stop + 1] - lo, metrics=('correlation',))[:, 0]
+
+    return (zscore_ranks(rdms) @ _shared['model_ranks'].T).astype(np.float32)
+
+#%%
+def searchlight_rsa(patterns, mask, affine, models, radius=6.0, n_procs=4, chunk_size=1000,
+                    cache_dir=None):
+    '''
+    Spearman rho of each sphere's correlation RDM with model RDMs
+
+    Input:
+        patterns: stim * in-mask voxel (order of np.flatnonzero(mask))
+        mask: boolean 3D mask
+        affine: affine of the mask
+        models: dict, model name: condensed model RDM (rdm_utils order)
+        radius: sphere radius in mm
+        n_procs: number of worker processes
+        chunk_size: centres per job
+        cache_dir: optional cache folder of sphere adjacencies
+
+    Output:
+        rho: dict, model name: rho of each in-mask voxel
+    '''
+    from multiprocessing import Pool
+    from rsa_stats import zscore_ranks
+
+    indptr, indices = cached_sphere_adjacency(mask, affine, radius, cache_dir)
+    model_names = list(models.keys())
+    model_ranks = zscore_ranks(np.array([models[name] for name in model_names]))
+
+    n_centre = len(indptr) - 1
+    jobs = [(start, min(start + chunk_size, n_centre))
+            for start in range(0, n_centre, chunk_size)]
+
+    with Pool(n_procs, initializer=_init_worker,
+              initargs=(np.asarray(patterns, dtype=np.float32), indptr, indices,
+                        model_ranks)) as pool:
+        rho = np.concatenate(pool.map(_searchlight_chunk, jobs))
+
+    return {name: rho[:, model_idx] for (model_idx, name) in enumerate(model_names)}
+
+#%%
+def run_searchlight(spmt_files, models, out_dir, mask_file=None, radius=6.0, n_procs=4,
+                    cache_dir=None):
+    '''
+    Searchlight RSA of one subject
+
+    Input:
+        spmt_files: the subject's spmT maps, in stim order
+        models: dict, model name: condensed model RDM for this subject
+        out_dir: output folder, searchlight_<model>.nii.gz per model
+        mask_file: optional mask; default the voxels finite and non-zero in
+            every spmT map
+        radius, n_procs, cache_dir: see searchlight_rsa
+
+    Output:
+        out_files: dict, model name: rho map
+    '''
+    import nibabel as nib
+    from group_level import unmask
+
+    first = nib.load(spmt_files[0])
+    data = np.stack([np.asanyarray(nib.load(spmt_file).dataobj, dtype=np.float32)
+                     for spmt_file in spmt_files])
+
+    if mask_file is not None:
+        from roi_atlas import mask_voxel_index
+        mask = np.zeros(first.shape[:3], dtype=bool)
+        mask.ravel()[mask_voxel_index(mask_file, first)] = True
+    else:
+        mask = np.all(np.isfinite(data) & (data != 0), axis=0)
+
+    rho = searchlight_rsa(data[:, mask], mask, first.affine, models, radius=radius,
+                          n_procs=n_procs, cache_dir=cache_dir)
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_files = {}
+    for (model_name, values) in rho.items():
+        out_file = os.path.join(out_dir, 'searchlight_%s.nii.gz' % model_name)
+        nib.Nifti1Image(unmask(values, mask), first.affine).to_filename(out_file)
+        out_files[model_name] = out_file
+
+    return out_files
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process Gaussian smoothing of 4D functional runs
+
+Separable 1D Gaussian kernels are applied along x, y and z, with the FWHM
+given in mm and converted to voxels from the NIfTI affine. Volumes are
+smoothed in chunks over time on a thread pool (scipy.ndimage releases the
+GIL), so no MATLAB session is needed to smooth a run.
+"""
+import os
+import numpy as np
+
+#%%
+def fwhm_to_sigma(fwhm, affine):
+    '''
+    Convert a smoothing kernel FWHM in mm to Gaussian sigmas in voxels
+
+    Input:
+        fwhm: full width at half maximum in mm, a scalar or one value per axis
+        affine: 4x4 voxel-to-world affine of the image
+
+    Output:
+        sigma: sigma of the gaussian along x, y, z, in voxels
+    '''
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float), (3,))
+    voxel_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+
+    return fwhm / voxel_size / np.sqrt(8 * np.log(2))
+
+#%%
+def gaussian_kernels(sigma, truncate=4.0):
+    '''
+    Normalized 1D gaussian kernels, one per spatial axis
+
+    Input:
+        sigma: sigma along each axis, in voxels
+        truncate: kernel half-width, in number of sigmas
+
+    Output:
+        kernels: list of 1D kernels (None for an axis with sigma 0)
+    '''
+    kernels = []
+    for sigma_axis in sigma:
+        if sigma_axis <= 0:
+            kernels.append(None)
+            continue
+        radius = max(int(truncate * sigma_axis + 0.5), 1)
+        x = np.arange(-radius, radius + 1, dtype=float)
+        kernel = np.exp(-0.5 * (x / sigma_axis) ** 2)
+        kernels.append((kernel / kernel.sum()).astype(np.float32))
+
+    return kernels
+
+#%%
+def smooth_volumes(data, kernels):
+    '''
+    Smooth a stack of volumes with separable kernels
+
+    Input:
+        data: float32 array, x * y * z (* volumes)
+        kernels: output of gaussian_kernels
+
+    Output:
+        smoothed: float32 array with the same shape as data
+    '''
+    from scipy import ndimage
+
+    smoothed = np.asarray(data, dtype=np.float32)
+    for (axis, kernel) in enumerate(kernels):
+        if kernel is not None:
+            smoothed = ndimage.convolve1d(smoothed, kernel, axis=axis,
+                                          mode='constant', cval=0.0)
+
+    return smoothed
+
+#%%
+def smooth_array(data, affine, fwhm, n_threads=4, chunk_size=16, out=None):
+    '''
+    Smooth a 4D run held in memory (or memory-mapped)
+
+    Input:
+        data: array, x * y * z * volumes
+        affine: 4x4 affine of the run
+        fwhm: kernel FWHM in mm; 0 returns the data unchanged
+        n_threads: number of threads smoothing chunks of volumes
+        chunk_size: number of volumes per chunk
+        out: optional float32 array (e.g. np.memmap) to write into
+
+    Output:
+        out: smoothed run, float32
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if np.all(np.asarray(fwhm) == 0):
+        return data
+
+    kernels = gaussian_kernels(fwhm_to_sigma(fwhm, affine))
+
+    if data.ndim == 3:
+        return smooth_volumes(data, kernels)
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+
+    def _smooth_chunk(start):
+        stop = min(start + chunk_size, data.shape[3])
+        out[..., start:stop] = smooth_volumes(
+                np.asarray(data[..., start:stop], dtype=np.float32), kernels)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        # list() re-raises any exception from the workers
+        list(pool.map(_smooth_chunk, range(0, data.shape[3], chunk_size)))
+
+    return out
+
+#%%
+def smooth_run(in_file, fwhm, out_file=None, n_threads=4, chunk_size=16):
+    '''
+    Smooth a 4D NIfTI run and write it to disk
+
+    Uncompressed outputs are written straight into a memory-mapped file, so
+    the smoothed run is never held in memory as a whole.
+
+    Input:
+        in_file: path of the 4D run
+        fwhm: kernel FWHM in mm; 0 returns in_file without writing anything
+        out_file: output path, default is 's' + file name in the current
+            directory (as spm.Smooth)
+        n_threads: number of threads
+        chunk_size: number of volumes per chunk
+
+    Output:
+        out_file: path of the smoothed run
+    '''
+    import nibabel as nib
+
+    if np.all(np.asarray(fwhm) == 0):
+        return in_file
+
+    if out_file is None:
+        out_file = os.path.abspath('s' + os.path.basename(in_file))
+
+    img = nib.load(in_file)
+
+    if out_file.endswith('.gz'):
+        data = smooth_array(img.dataobj, img.affine, fwhm, n_threads, chunk_size)
+        nib.Nifti1Image(data, img.affine, float32_header(img)).to_filename(out_file)
+        return out_file
+
+    out = nifti_memmap(img, out_file)
+    smooth_array(img.dataobj, img.affine, fwhm, n_threads, chunk_size, out=out)
+    out.flush()
+    del out
+
+    return out_file
+
+#%%
+def float32_header(img):
+    '''
+    Copy of an image header, with float32 data and no scaling
+    '''
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+
+    return header
+
+#%%
+def nifti_memmap(img, out_file):
+    '''
+    Create an uncompressed float32 NIfTI with the geometry of img, and map its
+    data into memory so it can be filled chunk by chunk
+
+    Input:
+        img: reference image (shape, affine and header are copied)
+        out_file: path of the .nii file to create
+
+    Output:
+        out: writable np.memmap, same shape as img
+    '''
+    header = float32_header(img)
+
+    # single file nifti: header, 4 bytes of extension flag, then the data
+    del header.extensions[:]
+    header['vox_offset'] = 352
+    out_dtype = header.get_data_dtype()
+    n_bytes = int(np.prod(img.shape)) * out_dtype.itemsize
+
+    with open(out_file, 'wb') as fobj:
+        header.write_to(fobj)
+        fobj.seek(352 + n_bytes - 1)
+        fobj.write(b'\0')
+
+    return np.memmap(out_file, dtype=out_dtype, mode='r+', offset=352,
+                     shape=img.shape, order='F')
+
+#%% Nipype function node
+def smooth_runs(in_files, fwhm, n_threads=4):
+    '''
+    Function node replacing spm.Smooth
+
+    Input:
+        in_files: a 4D run or a list of runs
+        fwhm: kernel FWHM in mm, 0 skips smoothing
+        n_threads: threads used for each run
+
+    Output:
+        smoothed_files: list of smoothed runs, written in the node directory
+    '''
+    from smoothing import smooth_run
+
+    if isinstance(in_files, str):
+        in_files = [in_files]
+
+    return [smooth_run(in_file, fwhm, n_threads=n_threads) for in_file in in_files]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming smoothness (FWHM) and resel count estimation from residuals
+
+As spm_est_smoothness, without holding the 4D residuals: residuals are read
+a chunk of volumes at a time, from per-volume images (level1estimate's
+residual_images), a packed Res.h5 store (residual_store.py) or any
+iterable of arrays, and only per-voxel sums are kept:
+    sum_sq      sum over volumes of r(v)^2
+    cross[d]    sum over volumes of r(v) * r(v + e_d), for each axis d
+
+Resel counts R0 to R3 (as SPM.xVol.R) follow from the FWHM and the numbers
+of points, edges, faces and cubes of the mask lattice (Worsley et al., 1996).
+"""
+import numpy as np
+
+#%%
+def residual_chunks(residuals, chunk_size=8):
+    '''
+    Iterate over residuals, a chunk of volumes at a time
+
+    Input:
+        residuals: list of 3D residual images, path of a residual store
+            (.h5), or an iterable of arrays (volume * x * y * z, or x * y * z)
+        chunk_size: volumes per chunk
+
+    Output:
+        generator of float64 arrays, volume * x * y * z
+    '''
+    if isinstance(residuals, str) and residuals.endswith('.h5'):
+        import h5py
+
+        with h5py.File(residuals, 'r') as store:
+            dataset = store['residuals']
+            for start in range(0, dataset.shape[0], chunk_size):
+                yield dataset[start:start + chunk_size].astype(np.float64)
+        return
+
+    if isinstance(residuals, (list, tuple)) and residuals and isinstance(residuals[0], str):
+        import nibabel as nib
+
+        for start in range(0, len(residuals), chunk_size):
+            yield np.stack([np.asanyarray(nib.load(res_file).dataobj, dtype=np.float64)
+                            for res_file in residuals[start:start + chunk_size]])
+        return
+
+    for chunk in residuals:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        yield chunk[None] if chunk.ndim == 3 else chunk
+
+#%%
+def empty_sums(shape):
+    '''
+    Zeroed sum_sq and cross accumulators for volumes of a given shape
+    '''
+    sum_sq = np.zeros(shape)
+    cross = [np.zeros(tuple(n - (axis == dim) for (dim, n) in enumerate(shape)))
+             for axis in range(3)]
+
+    return sum_sq, cross
+
+#%%
+def accumulate_sums(sum_sq, cross, chunk, mask):
+    '''
+    Add a chunk of residual volumes (volume * x * y * z) to the sums, in place;
+    voxels outside the mask or not finite count as 0
+    '''
+    chunk = np.where(mask & np.isfinite(chunk), chunk, 0)
+
+    sum_sq += np.sum(chunk ** 2, axis=0)
+    cross[0] += np.sum(chunk[:, :-1] * chunk[:, 1:], axis=0)
+    cross[1] += np.sum(chunk[:, :, :-1] * chunk[:, :, 1:], axis=0)
+    cross[2] += np.sum(chunk[:, :, :, :-1] * chunk[:, :, :, 1:], axis=0)
+
+#%%
+def smoothness_from_sums(sum_sq, cross, mask):
+    '''
+    FWHM of normalized residuals, from streamed sums
+
+    For unit-variance residuals z, var(z(v + e) - z(v)) = 2 - 2 * rho, with
+    rho the correlation of neighbouring voxels over time, and the FWHM of a
+    gaussian field is sqrt(4 * ln(2) / var) (as spm_est_smoothness).
+
+    Input:
+        sum_sq: x * y * z, sum over volumes of squared residuals
+        cross: list of 3 arrays, sum over volumes of r(v) * r(v + e) along
+            each axis (shape reduced by 1 along that axis)
+        mask: boolean mask
+
+    Output:
+        fwhm: FWHM along x, y, z, in voxels
+    '''
+    fwhm = np.zeros(3)
+    for axis in range(3):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        lo, hi = tuple(lo), tuple(hi)
+
+        valid = mask[lo] & mask[hi] & (sum_sq[lo] > 0) & (sum_sq[hi] > 0)
+        rho = cross[axis][valid] / np.sqrt(sum_sq[lo][valid] * sum_sq[hi][valid])
+        lam = np.mean(2 - 2 * rho)
+        fwhm[axis] = np.sqrt(4 * np.log(2) / lam)
+
+    return fwhm
+
+#%%
+def resel_counts(mask, fwhm):
+    '''
+    Resel counts R0 to R3 of a mask (as spm_resels_vol)
+
+    Input:
+        mask: boolean 3D mask
+        fwhm: FWHM along x, y, z, in voxels
+
+    Output:
+        resels: R0 (Euler characteristic) to R3 (resel volume)
+    '''
+    m = np.asarray(mask, dtype=bool)
+
+    points = m.sum()
+    edges = [np.sum(m[:-1] & m[1:]),
+             np.sum(m[:, :-1] & m[:, 1:]),
+             np.sum(m[:, :, :-1] & m[:, :, 1:])]
+    # faces in the xy, xz and yz planes
+    xy = m[:-1, :-1] & m[1:, :-1] & m[:-1, 1:] & m[1:, 1:]
+    xz = m[:-1, :, :-1] & m[1:, :, :-1] & m[:-1, :, 1:] & m[1:, :, 1:]
+    yz = m[:, :-1, :-1] & m[:, 1:, :-1] & m[:, :-1, 1:] & m[:, 1:, 1:]
+    faces = [xy.sum(), xz.sum(), yz.sum()]
+    cubes = np.sum(xy[:, :, :-1] & xy[:, :, 1:])
+
+    fx, fy, fz = fwhm
+    return np.array([points - sum(edges) + sum(faces) - cubes,
+                     (edges[0] - faces[0] - faces[1] + cubes) / fx
+                     + (edges[1] - faces[0] - faces[2] + cubes) / fy
+                     + (edges[2] - faces[1] - faces[2] + cubes) / fz,
+                     (faces[0] - cubes) / (fx * fy)
+                     + (faces[1] - cubes) / (fx * fz)
+                     + (faces[2] - cubes) / (fy * fz),
+                     cubes / (fx * fy * fz)], dtype=np.float64)
+
+#%%
+def estimate_smoothness(residuals, mask, chunk_size=8):
+    '''
+    FWHM and resel counts from residuals, streamed a chunk at a time
+
+    Input:
+        residuals: see residual_chunks
+        mask: boolean 3D mask, or a mask image path
+        chunk_size: volumes read at a time
+
+    Output:
+        fwhm: FWHM along x, y, z, in voxels
+        resels: R0 to R3
+    '''
+    if isinstance(mask, str):
+        import nibabel as nib
+        mask = np.asanyarray(nib.load(mask).dataobj) > 0
+
+    sum_sq, cross = empty_sums(mask.shape)
+    for chunk in residual_chunks(residuals, chunk_size):
+        accumulate_sums(sum_sq, cross, chunk, mask)
+
+    fwhm = smoothness_from_sums(sum_sq, cross, mask)
+
+    return fwhm, resel_counts(mask, fwhm)
+
+#%%
+def group_residual_chunks(con_files, mask, chunk_size=8):
+    '''
+    Residuals of a one-sample group model (subject con - group mean),
+    streamed from con images: one pass for the mean, one for the residuals
+
+    Input:
+        con_files: list of subjects' con images of one contrast
+        mask: boolean 3D mask
+        chunk_size: subjects per chunk
+
+    Output:
+        generator of arrays, subject * x * y * z
+    '''
+    mean = np.zeros(mask.shape)
+    for chunk in residual_chunks(con_files, chunk_size):
+        mean += np.nan_to_num(chunk).sum(axis=0)
+    mean /= len(con_files)
+
+    for chunk in residual_chunks(con_files, chunk_size):
+        yield chunk - mean
+
+#%%
+def stack_residual_chunks(data, mask, chunk_size=8):
+    '''
+    Residuals of a one-sample group model (subject con - group mean) from
+    con values already in memory, e.g. a cohort tensor
+    (cohort_tensor.load_cohort_stack)
+
+    Input:
+        data: subject * in-mask voxel
+        mask: boolean 3D mask of the voxels
+        chunk_size: subjects per chunk
+
+    Output:
+        generator of arrays, subject * x * y * z
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    mean = data.mean(axis=0)
+
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size]
+        volumes = np.zeros((len(chunk),) + mask.shape)
+        volumes[:, mask] = chunk - mean
+        yield volumes
@@ -20,6 +20,7 @@ out_root = '/home/rj299/scratch60/mdm_analysis/output'
 from nipype.interfaces import spm
 
 import nipype.interfaces.io as nio  # Data i/o
+from link_sink import LinkDataSink # links outputs into the sink instead of copying
 import nipype.interfaces.utility as util  # utility
 import nipype.pipeline.engine as pe  # pypeline engine
 #import nipype.algorithms.rapidart as ra  # artifact detection
@@ -31,8 +32,10 @@ from nipype.interfaces import fsl
 
 from nipype.interfaces.matlab import MatlabCommand
 
-import nibabel as nib
-from nilearn.input_data import NiftiMasker
+from smoothing import smooth_runs
+from residual_store import pack_residual_images
+from derivative_store import pack_derivatives
+
 
 #%%
 MatlabCommand.set_default_paths('/home/rj299/project/MATLAB/toolbox/spm12/') # set default SPM12 path in my computer. 
@@ -57,6 +60,10 @@ fwhm = 0
 tr = 1
 # first sevetal scans to delete
 del_scan = 10
+# pack residual images into one compressed 4D store instead of sinking one file per volume
+stream_residuals = True
+# also write betas, cons and spmT maps into one chunked float32 store per subject
+store_derivatives = True
 
 # Map field names to individual subject runs.
 # infosource = pe.Node(util.IdentityInterface(fields=['subject_id', 'task_id'],),
@@ -238,8 +245,15 @@ extract.inputs.t_min = del_scan
 extract.inputs.t_size = -1
 extract.inputs.output_type='NIFTI'
 
-# smoothing
-smooth = Node(spm.Smooth(), name="smooth", fwhm = fwhm)
+# smoothing, in python (spm.Smooth starts matlab and writes another copy of each run)
+#smooth = Node(spm.Smooth(), name="smooth", fwhm = fwhm)
+smooth = Node(util.Function(
+    input_names=['in_files', 'fwhm', 'n_threads'],
+    function=smooth_runs, output_names=['smoothed_files']),
+    name='smooth')
+smooth.inputs.fwhm = fwhm
+smooth.inputs.n_threads = 2
+smooth.n_procs = 2
 
 # set contrasts, depend on the condition
 contrasts = []
@@ -295,11 +309,12 @@ wfSPM_rsa.connect([
         (infosource, selectfiles, [('subject_id', 'subject_id')]),
         (selectfiles, runinfo, [('events','events_file'),('regressors','regressors_file')]),
         (selectfiles, extract, [('func','in_file')]),
-#        (extract, smooth, [('roi_file','in_files')]),
-        (extract, runinfo, [('roi_file','in_file')]),
-#        (smooth, runinfo, [('smoothed_files','in_file')]),
-        (extract, modelspec, [('roi_file', 'functional_runs')]), 
-#        (smooth, modelspec, [('smoothed_files', 'functional_runs')]),   
+        # fwhm = 0, smooth passes the extracted runs through untouched
+        (extract, smooth, [('roi_file','in_files')]),
+#        (extract, runinfo, [('roi_file','in_file')]),
+        (smooth, runinfo, [('smoothed_files','in_file')]),
+#        (extract, modelspec, [('roi_file', 'functional_runs')]), 
+        (smooth, modelspec, [('smoothed_files', 'functional_runs')]),   
         (runinfo, modelspec, [('info', 'subject_info'), ('realign_file', 'realignment_parameters')]),
         
         ])
@@ -327,17 +342,35 @@ wfSPM_rsa.connect([
 #%% Adding data sink
 ########################################################################
 # Datasink
-datasink = Node(nio.DataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
+datasink = Node(LinkDataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
                                          name="datasink")
                        
 wfSPM_rsa.connect([
         (level1estimate, datasink, [('beta_images',  '1stLevel.@betas.@beta_images'),
                                     ('residual_image', '1stLevel.@betas.@residual_image'),
-                                    ('residual_images', '1stLevel.@betas.@residual_images'),
                                     ('SDerror', '1stLevel.@betas.@SDerror'),
                                     ('SDbetas', '1stLevel.@betas.@SDbetas'),
                 ])
         ])
+
+# residuals: one store with ResMS, smoothness (and roi noise covariances),
+# computed while packing, instead of thousands of Res_XXXX.nii in the sink
+if stream_residuals:
+    residualstore = Node(util.Function(
+        input_names=['residual_images', 'mask_image', 'spm_mat_file', 'roi_masks'],
+        function=pack_residual_images, output_names=['residual_store']),
+        name='residualstore')
+
+    wfSPM_rsa.connect([
+            (level1estimate, residualstore, [('residual_images', 'residual_images'),
+                                             ('mask_image', 'mask_image'),
+                                             ('spm_mat_file', 'spm_mat_file')]),
+            (residualstore, datasink, [('residual_store', '1stLevel.@betas.@residual_store')]),
+            ])
+else:
+    wfSPM_rsa.connect([
+            (level1estimate, datasink, [('residual_images', '1stLevel.@betas.@residual_images')]),
+            ])
     
 wfSPM_rsa.connect([
        # here we take only the contrast ad spm.mat files of each subject and put it in different folder. It is more convenient like that. 
@@ -349,54 +382,78 @@ wfSPM_rsa.connect([
                                               ])
         ])
 
+# derivatives.h5: [map, x, y, z] float32 store of all betas, cons and spmT maps,
+# for partial (roi, searchlight) reads; the nifti files are still sunk for spm
+if store_derivatives:
+    derivativestore = Node(util.Function(
+        input_names=['beta_images', 'con_images', 'spmT_images'],
+        function=pack_derivatives, output_names=['derivative_store']),
+        name='derivativestore')
+
+    wfSPM_rsa.connect([
+            (level1estimate, derivativestore, [('beta_images', 'beta_images')]),
+            (contrastestimate, derivativestore, [('con_images', 'con_images'),
+                                                 ('spmT_images', 'spmT_images')]),
+            (derivativestore, datasink, [('derivative_store', '1stLevel.@derivatives')]),
+            ])
+
 #%% Compute ROI RDM
     
 def compute_roi_rdm(in_file,
                     stims,
-                    all_masks):
+                    all_masks,
+                    cache_dir=None,
+                    noise_file=None):
     
     from pathlib import Path
-    from nilearn.input_data import NiftiMasker
-    import numpy as np
     import nibabel as nib
+    import numpy as np
+    from roi_atlas import build_atlas
+    from rdm_kernel import default_metrics, rdm_matrices
+    from rdm_utils import condensed
     
     rdm_out = Path('roi_rdm.npy').resolve()
-    stim_num = len(stims)
+    rdm_tensor = Path('roi_rdm_tensor.npz').resolve()
+    
+    # load every stim's map once, stim * voxel
+    spmt_first = nib.load(in_file[0])
+    spmt_allstims = np.stack([np.asanyarray(nib.load(spmt_file).dataobj, dtype=np.float64).ravel()
+                              for spmt_file in in_file])
+    
+    # all rois compiled on the maps' grid, their patterns from a single gather
+    atlas = build_atlas(all_masks, spmt_first, cache_dir=cache_dir)
     
-    # dictionary to store rdms for all rois
+    # noise variance of each voxel (ResMS) for the mahalanobis metric, 
+    # which is left out without it
+    noise_var = None
+    if noise_file:
+        noise_var = atlas.gather(np.asanyarray(nib.load(noise_file).dataobj, 
+                                               dtype=np.float64).ravel())
+    metrics = default_metrics(noise_var)
+    
+    # rdms of all rois and metrics from the rois' gram matrices, 
+    # roi * metric * stim * stim
+    rdms = rdm_matrices(atlas.gather(spmt_allstims), atlas.indptr, metrics, noise_var)
+    
+    # dictionary to store the correlation rdms of all rois
     rdm_dict = {}
     
-    # loop over all rois
-    for mask_name in all_masks.keys():
-        mask = all_masks[mask_name]
-        masker = NiftiMasker(mask_img=mask)
-        
-        # initiate matrix
-        spmt_allstims_roi= np.zeros((stim_num, np.sum(mask.get_data())))
-            
-        for (stim_idx, spmt_file) in enumerate(in_file):
-            spmt = nib.load(spmt_file)
-          
-            # get each condition's beta
-            spmt_roi = masker.fit_transform(spmt)
-            spmt_allstims_roi[stim_idx, :] = spmt_roi
-        
-        # create rdm
-        rdm_roi = 1 - np.corrcoef(spmt_allstims_roi)
-        
-        rdm_dict[mask_name] = rdm_roi
+    for (roi_idx, mask_name) in enumerate(atlas.names):
+        rdm_dict[mask_name] = rdms[roi_idx, metrics.index('correlation')]
         
     # save    
     np.save(rdm_out, rdm_dict)
+    np.savez(rdm_tensor, rdms=condensed(rdms).astype(np.float32), rois=np.array(atlas.names), 
+             metrics=np.array(metrics), stims=np.array([stims[key] for key in sorted(stims)]))
     
-    return str(rdm_out)
+    return str(rdm_out), str(rdm_tensor)
 
 
 
 get_roi_rdm = Node(util.Function(
-    input_names=['in_file', 'stims', 'all_masks'],
+    input_names=['in_file', 'stims', 'all_masks', 'cache_dir', 'noise_file'],
     function=compute_roi_rdm, 
-    output_names=['rdm_out']),
+    output_names=['rdm_out', 'rdm_tensor']),
     name='get_roi_rdm',
     )    
     
@@ -418,22 +475,30 @@ maskfiles = {'vmpfc': maskfile_vmpfc,
              'med_mon_2': maskfile_roi2, 
              'med_mon_3': maskfile_roi3}
 
-# roi inputs are loaded images
-get_roi_rdm.inputs.all_masks = {key_name: nib.load(maskfiles[key_name]) for key_name in maskfiles.keys()}
+# roi inputs are mask paths; their voxel indices on the maps' grid are cached
+get_roi_rdm.inputs.all_masks = maskfiles
+get_roi_rdm.inputs.cache_dir = os.path.join(output_dir, 'roi_index_cache')
+
+# noise covariance of the residuals in each roi, computed while packing residuals
+if stream_residuals:
+    residualstore.inputs.roi_masks = maskfiles
 
 
 wfSPM_rsa.connect([
         (contrastestimate, get_roi_rdm, [('spmT_images', 'in_file')]),
+        # ResMS, the noise variance of each voxel for the mahalanobis rdms
+        (level1estimate, get_roi_rdm, [('residual_image', 'noise_file')]),
         ])
 
 #%% data sink rdm
 # Datasink
-datasink_rdm = Node(nio.DataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
+datasink_rdm = Node(LinkDataSink(base_directory=os.path.join(output_dir, 'Sink_resp_rsa_nosmooth')),
                                          name="datasink_rdm")
                        
 
 wfSPM_rsa.connect([
-        (get_roi_rdm, datasink_rdm, [('rdm_out', 'rdm.@rdm')]),
+        (get_roi_rdm, datasink_rdm, [('rdm_out', 'rdm.@rdm'),
+                                     ('rdm_tensor', 'rdm.@rdm_tensor')]),
         ])
     
 #%%
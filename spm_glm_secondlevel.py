@@ -7,13 +7,19 @@ Reference: https://github.com/poldracklab/ds003-post-fMRIPrep-analysis/blob/mast
 
 @author: rj299
 """
-import nipype.interfaces.io as nio  # Data i/o
+from link_sink import LinkDataSink # links outputs into the sink instead of copying
 from nipype.interfaces import spm
 from nipype import Node, Workflow, MapNode
 import nipype.interfaces.utility as util # utility
 from nipype import SelectFiles
 import os
 
+from group_level import run_group_ttests
+from thresholding import threshold_contrast_dirs
+from group_permutation import run_sign_flip_tests
+from group_regression import run_group_regression
+from cohort_tensor import build_cohort
+
 from nipype.interfaces.matlab import MatlabCommand
 MatlabCommand.set_default_paths('/home/rj299/project/MATLAB/toolbox/spm12/') # set default SPM12 path in my computer. 
 
@@ -41,6 +47,26 @@ subject_list = [2073, 2550, 2582, 2583, 2584, 2585, 2588, 2592, 2593, 2594,
                 2654, 2655, 2656, 2657, 2658, 2659, 2660, 2661, 2662, 2663, 
                 2664, 2665, 2666]
 
+sink_dir = '/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp/'
+
+# 'spm': a matlab design/estimate/contrast/threshold chain for each contrast
+# 'numpy': t maps of all contrasts in one pass in python (group_level.py)
+# 'permutation': sign-flip permutations with TFCE and max-t FWE p maps
+#                (group_permutation.py), randomise-style outputs
+# 'regression': maps of con values regressed on behavioural covariates
+#               (group_regression.py), Freedman-Lane permutations
+group_engine = 'spm'
+
+n_perm = 5000
+perm_seed = 0
+perm_procs = 8
+
+# covariates for 'regression', <column>_med / <column>_mon of the csv files
+data_behav_root = '/home/rj299/project/mdm_analysis/data_behav'
+covariate_files = [os.path.join(data_behav_root, 'par_09300219.csv'),
+                   os.path.join(data_behav_root, 'rating_11082019.csv')]
+covariate_list = ['alpha_med', 'alpha_mon', 'beta_med', 'beta_mon']
+
 # Threshold - thresholds contrasts
 level2thresh = Node(spm.Threshold(contrast_index=1,
                               use_topo_fdr=True,
@@ -60,7 +86,7 @@ infosource.iterables = [('contrast_id', contrast_list)]
 infosource.inputs.subject_id = subject_list
 
 # SelectFiles - to grab the data (alternative to DataGrabber)
-templates = {'cons': os.path.join('/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp/1stLevel/_subject_id_{subject_id}/', 
+templates = {'cons': os.path.join(sink_dir, '1stLevel', '_subject_id_{subject_id}', 
                          '{contrast_id}.nii')}
 
 selectfiles = MapNode(SelectFiles(templates,
@@ -69,7 +95,7 @@ selectfiles = MapNode(SelectFiles(templates,
                    name="selectfiles", 
                    iterfield = ['subject_id'])
 
-datasink = Node(nio.DataSink(base_directory='/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp/'),
+datasink = Node(LinkDataSink(base_directory=sink_dir),
                 name="datasink")
 
 
@@ -107,5 +133,28 @@ l2analysis.connect([(infosource, selectfiles, [('contrast_id', 'contrast_id'),
 #%% graph
 l2analysis.write_graph(graph2use = 'flat')
 #%%                                                     
-#l2analysis.run('MultiProc', plugin_args={'n_procs': 3})
-l2analysis.run('Linear', plugin_args={'n_procs': 1})
\ No newline at end of file
+if group_engine == 'numpy':
+    run_group_ttests(os.path.join(sink_dir, '1stLevel'), subject_list, contrast_list,
+                     os.path.join(sink_dir, '2ndLevel_heightp05'),
+                     cohort_dir=os.path.join(sink_dir, 'cohort'))
+    # python counterpart of level2thresh, all contrasts in one batch, with
+    # resels estimated from the group residuals of the cohort tensor
+    threshold_contrast_dirs(os.path.join(sink_dir, '2ndLevel_heightp05'), contrast_list,
+                            df=len(subject_list) - 1,
+                            cohort_dir=os.path.join(sink_dir, 'cohort'), subjects=subject_list,
+                            height=0.05, fwe=True, extent=10, topo_fdr=True, fdr_q=0.05)
+elif group_engine == 'permutation':
+    run_sign_flip_tests(os.path.join(sink_dir, '1stLevel'), subject_list, contrast_list,
+                        os.path.join(sink_dir, '2ndLevel_permutation'),
+                        n_perm=n_perm, seed=perm_seed, n_procs=perm_procs,
+                        cohort_dir=os.path.join(sink_dir, 'cohort'))
+elif group_engine == 'regression':
+    build_cohort(os.path.join(sink_dir, 'cohort'), os.path.join(sink_dir, '1stLevel'),
+                 subject_list, contrast_list)
+    run_group_regression(os.path.join(sink_dir, 'cohort'), subject_list, contrast_list,
+                         covariate_list, covariate_files,
+                         os.path.join(sink_dir, '2ndLevel_regression'),
+                         n_perm=n_perm, seed=perm_seed, n_procs=perm_procs)
+else:
+    #l2analysis.run('MultiProc', plugin_args={'n_procs': 3})
+    l2analysis.run('Linear', plugin_args={'n_procs': 1})
\ No newline at end of file
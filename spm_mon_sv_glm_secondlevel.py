@@ -7,13 +7,16 @@ Reference: https://github.com/poldracklab/ds003-post-fMRIPrep-analysis/blob/mast
 
 @author: rj299
 """
-import nipype.interfaces.io as nio  # Data i/o
+from link_sink import LinkDataSink # links outputs into the sink instead of copying
 from nipype.interfaces import spm
 from nipype import Node, Workflow, MapNode
 import nipype.interfaces.utility as util # utility
 from nipype import SelectFiles
 import os
 
+from group_level import run_group_ttests
+from thresholding import threshold_contrast_dirs
+
 from nipype.interfaces.matlab import MatlabCommand
 MatlabCommand.set_default_paths('/home/rj299/project/MATLAB/toolbox/spm12/') # set default SPM12 path in my computer. 
 
@@ -42,6 +45,12 @@ subject_list = [2073, 2550, 2582, 2583, 2584, 2585, 2588, 2592, 2593, 2594,
                 2654, 2655, 2656, 2657, 2658, 2659, 2660, 2661, 2662, 2663, 
                 2664, 2665, 2666]
 
+sink_dir = '/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_mon_sv/'
+
+# 'spm': a matlab design/estimate/contrast/threshold chain for each contrast
+# 'numpy': t maps of all contrasts in one pass in python (group_level.py)
+group_engine = 'spm'
+
 
 # Threshold - thresholds contrasts
 level2thresh = Node(spm.Threshold(contrast_index=1,
@@ -63,7 +72,7 @@ infosource.iterables = [('contrast_id', contrast_list)]
 infosource.inputs.subject_id = subject_list
 
 # SelectFiles - to grab the data (alternative to DataGrabber)
-templates = {'cons': os.path.join('/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_mon_sv/1stLevel/_subject_id_{subject_id}/', 
+templates = {'cons': os.path.join(sink_dir, '1stLevel', '_subject_id_{subject_id}', 
                          '{contrast_id}.nii')}
 
 selectfiles = MapNode(SelectFiles(templates,
@@ -72,7 +81,7 @@ selectfiles = MapNode(SelectFiles(templates,
                    name="selectfiles", 
                    iterfield = ['subject_id'])
 
-datasink = Node(nio.DataSink(base_directory='/home/rj299/scratch60/mdm_analysis/output/imaging/Sink_resp_mon_sv/'),
+datasink = Node(LinkDataSink(base_directory=sink_dir),
                 name="datasink")
 
 
@@ -108,5 +117,16 @@ l2analysis.connect([(infosource, selectfiles, [('contrast_id', 'contrast_id'),
                                                '2ndLevel_heightp05.@threshold')]),
                                                         ])
 #%%                                                     
-l2analysis.run('MultiProc', plugin_args={'n_procs': 4})
-#l2analysis.run('Linear', plugin_args={'n_procs': 1})
\ No newline at end of file
+if group_engine == 'numpy':
+    run_group_ttests(os.path.join(sink_dir, '1stLevel'), subject_list, contrast_list,
+                     os.path.join(sink_dir, '2ndLevel_heightp05'),
+                     cohort_dir=os.path.join(sink_dir, 'cohort'))
+    # python counterpart of level2thresh, all contrasts in one batch, with
+    # resels estimated from the group residuals of the cohort tensor
+    threshold_contrast_dirs(os.path.join(sink_dir, '2ndLevel_heightp05'), contrast_list,
+                            df=len(subject_list) - 1,
+                            cohort_dir=os.path.join(sink_dir, 'cohort'), subjects=subject_list,
+                            height=0.05, fwe=True, extent=10, topo_fdr=True, fdr_q=0.05)
+else:
+    l2analysis.run('MultiProc', plugin_args={'n_procs': 4})
+    #l2analysis.run('Linear', plugin_args={'n_procs': 1})
\ No newline at end of file
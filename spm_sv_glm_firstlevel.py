@@ -20,6 +20,7 @@ out_root = '/home/rj299/scratch60/mdm_analysis/output'
 from nipype.interfaces import spm
 
 import nipype.interfaces.io as nio  # Data i/o
+from link_sink import LinkDataSink # links outputs into the sink instead of copying
 import nipype.interfaces.utility as util  # utility
 import nipype.pipeline.engine as pe  # pypeline engine
 #import nipype.algorithms.rapidart as ra  # artifact detection
@@ -31,6 +32,10 @@ from nipype.interfaces import fsl
 
 from nipype.interfaces.matlab import MatlabCommand
 
+from smoothing import smooth_runs
+from residual_store import pack_residual_images
+from derivative_store import pack_derivatives
+
 #%%
 MatlabCommand.set_default_paths('/home/rj299/project/MATLAB/toolbox/spm12/') # set default SPM12 path in my computer. 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
@@ -56,6 +61,10 @@ fwhm = 6
 tr = 1
 # first sevetal scans to delete
 del_scan = 10
+# pack residual images into one compressed 4D store instead of sinking one file per volume
+stream_residuals = True
+# also write betas, cons and spmT maps into one chunked float32 store per subject
+store_derivatives = True
 
 # Map field names to individual subject runs.
 # infosource = pe.Node(util.IdentityInterface(fields=['subject_id', 'task_id'],),
@@ -210,8 +219,15 @@ extract.inputs.t_min = del_scan
 extract.inputs.t_size = -1
 extract.inputs.output_type='NIFTI'
 
-# smoothing
-smooth = Node(spm.Smooth(), name="smooth", fwhm = fwhm)
+# smoothing, in python (spm.Smooth starts matlab and writes another copy of each run)
+#smooth = Node(spm.Smooth(), name="smooth", fwhm = fwhm)
+smooth = Node(util.Function(
+    input_names=['in_files', 'fwhm', 'n_threads'],
+    function=smooth_runs, output_names=['smoothed_files']),
+    name='smooth')
+smooth.inputs.fwhm = fwhm
+smooth.inputs.n_threads = 2
+smooth.n_procs = 2
 
 # set contrasts, depend on the condition
 cond_names = ['Med_amb', 'Med_ambxMed_amb_sv^1', 'Med_risk', 'Med_riskxMed_risk_sv^1',
@@ -298,18 +314,36 @@ wfSPM.connect([
 #%% Adding data sink
 ########################################################################
 # Datasink
-datasink = Node(nio.DataSink(base_directory=os.path.join(output_dir, 'Sink_resp_sv')),
+datasink = Node(LinkDataSink(base_directory=os.path.join(output_dir, 'Sink_resp_sv')),
                                          name="datasink")
                        
 wfSPM.connect([
         (level1estimate, datasink, [('beta_images',  '1stLevel.@betas.@beta_images'),
                                     ('residual_image', '1stLevel.@betas.@residual_image'),
-                                    ('residual_images', '1stLevel.@betas.@residual_images'),
                                     ('SDerror', '1stLevel.@betas.@SDerror'),
                                     ('SDbetas', '1stLevel.@betas.@SDbetas'),
                 ])
         ])
 
+# residuals: one store with ResMS, smoothness (and roi noise covariances),
+# computed while packing, instead of thousands of Res_XXXX.nii in the sink
+if stream_residuals:
+    residualstore = Node(util.Function(
+        input_names=['residual_images', 'mask_image', 'spm_mat_file', 'roi_masks'],
+        function=pack_residual_images, output_names=['residual_store']),
+        name='residualstore')
+
+    wfSPM.connect([
+            (level1estimate, residualstore, [('residual_images', 'residual_images'),
+                                             ('mask_image', 'mask_image'),
+                                             ('spm_mat_file', 'spm_mat_file')]),
+            (residualstore, datasink, [('residual_store', '1stLevel.@betas.@residual_store')]),
+            ])
+else:
+    wfSPM.connect([
+            (level1estimate, datasink, [('residual_images', '1stLevel.@betas.@residual_images')]),
+            ])
+
 wfSPM.connect([
        # here we take only the contrast ad spm.mat files of each subject and put it in different folder. It is more convenient like that. 
        (contrastestimate, datasink, [('spm_mat_file', '1stLevel.@spm_mat'),
@@ -320,6 +354,21 @@ wfSPM.connect([
                                               ])
         ])
 
+# derivatives.h5: [map, x, y, z] float32 store of all betas, cons and spmT maps,
+# for partial (roi, searchlight) reads; the nifti files are still sunk for spm
+if store_derivatives:
+    derivativestore = Node(util.Function(
+        input_names=['beta_images', 'con_images', 'spmT_images'],
+        function=pack_derivatives, output_names=['derivative_store']),
+        name='derivativestore')
+
+    wfSPM.connect([
+            (level1estimate, derivativestore, [('beta_images', 'beta_images')]),
+            (contrastestimate, derivativestore, [('con_images', 'con_images'),
+                                                 ('spmT_images', 'spmT_images')]),
+            (derivativestore, datasink, [('derivative_store', '1stLevel.@derivatives')]),
+            ])
+
 #%% run
     
 wfSPM.run('MultiProc', plugin_args={'n_procs': 4})
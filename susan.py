@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SUSAN edge-preserving smoothing on numpy arrays
+
+Same steps as nipype's create_susan_smooth workflow (mask the run, take the
+median inside the brain mask, susan with the mean image as USAN and 0.75 *
+median as brightness threshold, mask with the dilated brain mask), without
+calling FSL or writing any intermediate image.
+
+The USAN weights only depend on the mean image, so they are computed once
+per run; each chunk of volumes is then a weighted sum over kernel offsets.
+"""
+import os
+import numpy as np
+
+#%%
+def susan_weights(usan, mask, out_mask, affine, fwhm, brightness_threshold,
+                  truncate=3.0):
+    '''
+    Precompute SUSAN neighbour indices and weights
+
+    Input:
+        usan: 3D image the brightness similarity is computed on (masked mean)
+        mask: boolean brain mask, voxels carrying data
+        out_mask: boolean mask of the voxels to smooth (dilated brain mask)
+        affine: 4x4 affine, for voxel sizes
+        fwhm: kernel FWHM in mm
+        brightness_threshold: SUSAN brightness threshold
+        truncate: kernel radius, in number of sigmas
+
+    Output:
+        neighbours: int32 array, offsets * output voxels, index of each
+            neighbour among the in-mask voxels (n_mask for voxels outside
+            the mask, which carry 0 as in the masked run)
+        weights: float32 array, offsets * output voxels
+    '''
+    from smoothing import fwhm_to_sigma
+
+    shape = mask.shape
+    n_mask = int(mask.sum())
+    sigma_vox = fwhm_to_sigma(fwhm, affine)
+    sigma_mm = fwhm / np.sqrt(8 * np.log(2))
+    voxel_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+
+    # kernel offsets inside an ellipsoid, centre excluded
+    radius = np.maximum(np.ceil(truncate * sigma_vox).astype(int), 1)
+    grid = np.mgrid[-radius[0]:radius[0] + 1,
+                    -radius[1]:radius[1] + 1,
+                    -radius[2]:radius[2] + 1].reshape(3, -1).T
+    inside = np.sum((grid / radius) ** 2, axis=1) <= 1
+    centre = np.all(grid == 0, axis=1)
+    offsets = grid[inside & ~centre]
+    dist2 = np.sum((offsets * voxel_size) ** 2, axis=1)
+
+    # padded lookups: index among mask voxels, usan value, inside volume
+    pad = [(r, r) for r in radius]
+    lookup = np.full(shape, n_mask, dtype=np.int32)
+    lookup[mask] = np.arange(n_mask, dtype=np.int32)
+    lookup = np.pad(lookup, pad, mode='constant', constant_values=n_mask)
+    usan_pad = np.pad(np.where(mask, usan, 0).astype(np.float32), pad, mode='constant')
+    in_volume = np.pad(np.ones(shape, dtype=bool), pad, mode='constant')
+
+    centres = np.argwhere(out_mask) + radius
+    usan_centre = usan_pad[tuple(centres.T)]
+
+    neighbours = np.empty((len(offsets), len(centres)), dtype=np.int32)
+    weights = np.empty((len(offsets), len(centres)), dtype=np.float32)
+
+    for (off_idx, offset) in enumerate(offsets):
+        coords = tuple((centres + offset).T)
+        neighbours[off_idx] = lookup[coords]
+        brightness = (usan_pad[coords] - usan_centre) / brightness_threshold
+        weights[off_idx] = np.exp(-dist2[off_idx] / (2 * sigma_mm ** 2)
+                                  - brightness ** 2) * in_volume[coords]
+
+    return neighbours, weights
+
+#%%
+def susan_smooth(data, mask, affine, fwhm, n_threads=4, chunk_size=16,
+                 brightness_factor=0.75, out=None):
+    '''
+    SUSAN smoothing of a 4D run
+
+    Input:
+        data: array (or nibabel dataobj), x * y * z * volumes
+        mask: 3D brain mask
+        affine: 4x4 affine of the run
+        fwhm: kernel FWHM in mm
+        n_threads: number of threads smoothing chunks of volumes
+        chunk_size: number of volumes per chunk
+        brightness_factor: brightness threshold, as a fraction of the median
+            inside the brain mask
+        out: optional float32 array (e.g. np.memmap) to write into
+
+    Output:
+        out: smoothed run, float32, zero outside the dilated mask
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from scipy import ndimage
+
+    mask = np.asarray(mask) > 0
+    out_mask = ndimage.binary_dilation(mask, structure=np.ones((3, 3, 3)))
+    n_vol = data.shape[3]
+
+    # usan: mean of the masked run, accumulated chunk by chunk
+    usan = np.zeros(mask.sum(), dtype=np.float64)
+    for start in range(0, n_vol, chunk_size):
+        chunk = np.asarray(data[..., start:start + chunk_size], dtype=np.float32)
+        usan += chunk[mask].sum(axis=1)
+    usan /= n_vol
+    usan_img = np.zeros(mask.shape, dtype=np.float32)
+    usan_img[mask] = usan
+
+    # median of the masked mean stands in for fslstats -k mask -p 50 on the run
+    brightness_threshold = brightness_factor * np.median(usan)
+
+    neighbours, weights = susan_weights(usan_img, mask, out_mask, affine, fwhm,
+                                        brightness_threshold)
+    norm = weights.sum(axis=0)
+
+    # where no neighbour is similar enough, susan falls back to the local median
+    no_usan = np.flatnonzero(norm < 1e-10)
+    norm[no_usan] = 1
+    if len(no_usan):
+        lookup = np.full(mask.shape, mask.sum(), dtype=np.int64)
+        lookup[mask] = np.arange(mask.sum())
+        lookup = np.pad(lookup, 1, mode='constant', constant_values=mask.sum())
+        box = np.argwhere(np.ones((3, 3, 3))) - 1
+        centres = np.argwhere(out_mask)[no_usan] + 1
+        median_neighbours = np.stack([lookup[tuple((centres + offset).T)]
+                                      for offset in box], axis=1)
+
+    if out is None:
+        out = np.zeros(data.shape, dtype=np.float32)
+
+    def _smooth_chunk(start):
+        stop = min(start + chunk_size, n_vol)
+        chunk = np.asarray(data[..., start:stop], dtype=np.float32)
+        # in-mask values plus a row of zeros for neighbours outside the mask
+        values = np.vstack([chunk[mask], np.zeros((1, stop - start), np.float32)])
+
+        smoothed = np.zeros((weights.shape[1], stop - start), dtype=np.float32)
+        for off_idx in range(weights.shape[0]):
+            smoothed += weights[off_idx][:, None] * values[neighbours[off_idx]]
+        smoothed /= norm[:, None]
+
+        if len(no_usan):
+            smoothed[no_usan] = np.median(values[median_neighbours], axis=1)
+
+        out_chunk = np.zeros(chunk.shape, dtype=np.float32)
+        out_chunk[out_mask] = smoothed
+        out[..., start:stop] = out_chunk
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(_smooth_chunk, range(0, n_vol, chunk_size)))
+
+    return out
+
+#%%
+def susan_run(in_file, mask_file, fwhm, out_file=None, n_threads=4, chunk_size=16):
+    '''
+    SUSAN smoothing of a 4D NIfTI run, written straight to its output file
+
+    Input:
+        in_file: path of the 4D run
+        mask_file: path of the brain mask
+        fwhm: kernel FWHM in mm; 0 returns in_file
+        out_file: output path, default is <name>_smooth.nii in the current
+            directory
+        n_threads: number of threads
+        chunk_size: number of volumes per chunk
+
+    Output:
+        out_file: path of the smoothed run
+    '''
+    import nibabel as nib
+    from smoothing import nifti_memmap
+
+    if fwhm == 0:
+        return in_file
+
+    if out_file is None:
+        name = os.path.basename(in_file).split('.nii')[0]
+        out_file = os.path.abspath(name + '_smooth.nii')
+
+    img = nib.load(in_file)
+    mask = np.asanyarray(nib.load(mask_file).dataobj)
+
+    out = nifti_memmap(img, out_file)
+    susan_smooth(img.dataobj, mask, img.affine, fwhm, n_threads, chunk_size, out=out)
+    out.flush()
+    del out
+
+    return out_file
+
+#%% Nipype function node
+def susan_smooth_runs(in_files, mask_files, fwhm, n_threads=4):
+    '''
+    Function node replacing create_susan_smooth
+
+    Input:
+        in_files: a 4D run or a list of runs
+        mask_files: brain mask(s), one per run
+        fwhm: kernel FWHM in mm
+        n_threads: threads used for each run
+
+    Output:
+        smoothed_files: smoothed run(s), same type as in_files
+    '''
+    from susan import susan_run
+
+    if isinstance(in_files, str):
+        return susan_run(in_files, mask_files, fwhm, n_threads=n_threads)
+
+    return [susan_run(in_file, mask_file, fwhm, n_threads=n_threads)
+            for (in_file, mask_file) in zip(in_files, mask_files)]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LinkDataSink: outputs are linked into the sink and recorded in the manifest
+"""
+import os
+import json
+
+import pytest
+
+pytest.importorskip('nipype')
+
+from link_sink import LinkDataSink, file_checksum
+
+
+def _sink(tmp_path, src, **inputs):
+    sink = LinkDataSink(base_directory=str(tmp_path / 'sink'), **inputs)
+    setattr(sink.inputs, '1stLevel.@con', str(src))
+    (tmp_path / 'work').mkdir()
+    sink.run(cwd=str(tmp_path / 'work'))
+
+    return tmp_path / 'sink'
+
+
+def _manifest(sink_dir):
+    with open(str(sink_dir / 'sink_manifest.jsonl')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_hardlink_and_manifest(tmp_path):
+    src = tmp_path / 'con_0001.nii'
+    src.write_bytes(b'contrast values')
+
+    sink_dir = _sink(tmp_path, src, link_mode='hardlink')
+    dst = sink_dir / '1stLevel' / 'con_0001.nii'
+
+    assert os.path.samefile(str(src), str(dst))
+    entries = _manifest(sink_dir)
+    assert len(entries) == 1
+    assert entries[0]['destination'] == os.path.join('1stLevel', 'con_0001.nii')
+    assert entries[0]['source'] == str(src)
+    assert entries[0]['mode'] == 'hardlink'
+    assert entries[0]['sha256'] == file_checksum(str(src))
+
+
+def test_copy_mode(tmp_path):
+    src = tmp_path / 'con_0001.nii'
+    src.write_bytes(b'contrast values')
+
+    sink_dir = _sink(tmp_path, src, link_mode='copy', checksum=False)
+    dst = sink_dir / '1stLevel' / 'con_0001.nii'
+
+    assert not os.path.samefile(str(src), str(dst))
+    assert dst.read_bytes() == b'contrast values'
+    entries = _manifest(sink_dir)
+    assert entries[0]['mode'] == 'copy'
+    assert 'sha256' not in entries[0]
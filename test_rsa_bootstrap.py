@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bootstrap_medians against np.median of the same resamples
+"""
+import time
+
+import numpy as np
+import pytest
+
+from rsa_bootstrap import bootstrap_indices, bootstrap_medians
+
+
+def _reference_medians(rho, n_boot, seed):
+    index = bootstrap_indices(np.random.default_rng(seed), n_boot, rho.shape[0])
+
+    return np.concatenate([np.median(rho[index[start:start + 1000]], axis=1)
+                           for start in range(0, n_boot, 1000)])
+
+
+@pytest.mark.parametrize('n_sub', [33, 32])
+def test_equal_to_np_median(n_sub):
+    rho = np.random.default_rng(1).standard_normal((n_sub, 24, 5))
+    # ties and a nan subject in one cell
+    rho[:5, 0, 0] = 0.5
+    rho[3, 1, 1] = np.nan
+
+    medians = bootstrap_medians(rho, n_boot=2000, seed=3, batch_size=300)
+
+    np.testing.assert_array_equal(medians, _reference_medians(rho, 2000, 3))
+
+
+def test_faster_than_np_median():
+    rho = np.random.default_rng(1).standard_normal((33, 24, 5))
+
+    start = time.perf_counter()
+    bootstrap_medians(rho, n_boot=10000, seed=3)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _reference_medians(rho, 10000, 3)
+    reference = time.perf_counter() - start
+
+    assert elapsed < reference
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python thresholding of second-level t maps, replacing spm.Threshold
+
+As level2thresh in the second-level scripts:
+    - height threshold, FWE corrected with random field theory (the lower
+      of the RFT and Bonferroni thresholds, as spm_uc) or uncorrected
+    - connected clusters (6, 18 or 26 connectivity, 18 as SPM)
+    - extent threshold in voxels
+    - topological FDR on cluster p values (Chumbley & Friston, 2009)
+
+The t maps of all contrasts are labelled in one ndimage.label call, with a
+4D structure that does not connect contrasts, and the mask index is
+computed once. Outputs keep the nipype names: <contrast dir>/
+spmT_0001_thr.nii, plus a clusters.csv table.
+"""
+import os
+import numpy as np
+
+# connectivity (6, 18, 26) to scipy.ndimage structure rank
+CONNECTIVITY_RANK = {6: 1, 18: 2, 26: 3}
+
+#%%
+def t_ec_densities(u, df):
+    '''
+    Euler characteristic densities of a 3D t field at threshold u (Worsley
+    et al., 1996), per resel, for dimensions 0 to 3
+    '''
+    from scipy import stats
+    from scipy.special import gammaln
+
+    a = 4 * np.log(2)
+    base = (1 + u ** 2 / df) ** (-(df - 1) / 2)
+
+    return np.array([stats.t.sf(u, df),
+                     np.sqrt(a) / (2 * np.pi) * base,
+                     a / (2 * np.pi) ** 1.5 * np.exp(gammaln((df + 1) / 2) - gammaln(df / 2))
+                     / np.sqrt(df / 2) * u * base,
+                     a ** 1.5 / (2 * np.pi) ** 2 * ((df - 1) / df * u ** 2 - 1) * base])
+
+#%%
+def expected_ec(u, df, resels):
+    '''
+    Expected Euler characteristic (number of clusters) above u, with resel
+    counts R0 to R3 (SPM.xVol.R)
+    '''
+    return np.dot(resels, t_ec_densities(u, df))
+
+#%%
+def height_threshold(height, df, n_voxels, resels=None, fwe=True, height_type='p-value'):
+    '''
+    Cluster-forming t threshold
+
+    Input:
+        height: p value, or t value with height_type 'stat'
+        df: error degrees of freedom
+        n_voxels: number of voxels in the mask (Bonferroni)
+        resels: resel counts R0 to R3, None for Bonferroni only
+        fwe: FWE corrected threshold, else uncorrected
+        height_type: 'p-value' or 'stat'
+
+    Output:
+        u: t threshold
+    '''
+    from scipy import stats, optimize
+
+    if height_type == 'stat':
+        return float(height)
+    if not fwe:
+        return float(stats.t.isf(height, df))
+
+    u = float(stats.t.isf(height / n_voxels, df))
+    if resels is not None:
+        # the expected EC decreases above ~2, where FWE thresholds lie
+        func = lambda x: expected_ec(x, df, resels) - height
+        if func(2) > 0 > func(100):
+            u = min(u, optimize.brentq(func, 2, 100))
+
+    return u
+
+#%%
+def cluster_p_values(sizes, u, df, n_voxels, resels):
+    '''
+    Uncorrected cluster p values, P(extent >= k) = exp(-beta * k^(2/3)), with
+    beta from the expected number of voxels and of clusters above u
+    '''
+    from scipy import stats
+    from scipy.special import gamma
+
+    expected_voxels = n_voxels * stats.t.sf(u, df)
+    expected_clusters = expected_ec(u, df, resels)
+    beta = (gamma(2.5) * expected_clusters / expected_voxels) ** (2 / 3)
+
+    return np.exp(-beta * np.asarray(sizes, dtype=np.float64) ** (2 / 3))
+
+#%%
+def fdr_keep(p_values, q=0.05):
+    '''
+    Benjamini-Hochberg: boolean array of the p values kept at level q
+    '''
+    p_values = np.asarray(p_values)
+    if p_values.size == 0:
+        return np.zeros(0, dtype=bool)
+
+    order = np.sort(p_values)
+    passed = order <= q * np.arange(1, len(order) + 1) / len(order)
+    if not passed.any():
+        return np.zeros(len(p_values), dtype=bool)
+
+    return p_values <= order[np.flatnonzero(passed)[-1]]
+
+#%%
+def threshold_maps(t_maps, mask, df, resels=None, height=0.05, fwe=True,
+                   height_type='p-value', extent=10, topo_fdr=True, fdr_q=0.05,
+                   connectivity=18, affine=None):
+    '''
+    Threshold the t maps of all contrasts in one batch
+
+    Input:
+        t_maps: contrast * in-mask voxel t values
+        mask: boolean 3D mask of the voxels
+        df: error degrees of freedom
+        resels: resel counts R0 to R3, for all contrasts or one row per
+            contrast (None: Bonferroni height, no topo FDR)
+        height, fwe, height_type: see height_threshold
+        extent: minimum cluster size in voxels
+        topo_fdr: also drop clusters failing FDR on cluster p values
+        fdr_q: FDR level of topo_fdr
+        connectivity: 6, 18 or 26
+        affine: for peak coordinates in mm in the table
+
+    Output:
+        thresholded: contrast * in-mask voxel, t where kept, 0 elsewhere
+        table: pandas DataFrame, one row per kept cluster
+        u: cluster-forming t threshold of each contrast
+    '''
+    import pandas as pd
+    from scipy import ndimage
+    from group_level import unmask
+
+    t_maps = np.nan_to_num(np.asarray(t_maps, dtype=np.float32))
+    n_con, n_voxels = t_maps.shape
+    if resels is not None:
+        resels = np.broadcast_to(np.asarray(resels, dtype=np.float64), (n_con, 4))
+    u = np.array([height_threshold(height, df, n_voxels,
+                                   None if resels is None else resels[con_idx],
+                                   fwe, height_type)
+                  for con_idx in range(n_con)])
+
+    volumes = unmask(t_maps, mask, fill=0)
+    structure = np.zeros((3, 3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(3, CONNECTIVITY_RANK[connectivity])
+    labels, n_clusters = ndimage.label(volumes > u[:, None, None, None], structure)
+
+    index = np.arange(1, n_clusters + 1)
+    sizes = np.bincount(labels.ravel(), minlength=n_clusters + 1)[1:]
+    peaks = np.array(ndimage.maximum_position(volumes, labels, index), dtype=int).reshape(-1, 4)
+    peak_t = volumes[tuple(peaks.T)] if n_clusters else np.zeros(0)
+
+    keep = sizes >= extent
+    p_unc = np.full(n_clusters, np.nan)
+    if resels is not None:
+        # cluster p values and FDR within each contrast, over its clusters
+        # above the extent
+        for con_idx in np.unique(peaks[:, 0]):
+            in_con = peaks[:, 0] == con_idx
+            p_unc[in_con] = cluster_p_values(sizes[in_con], u[con_idx], df, n_voxels,
+                                             resels[con_idx])
+            if topo_fdr:
+                in_con &= keep
+                keep[in_con] = fdr_keep(p_unc[in_con], fdr_q)
+
+    keep_label = np.concatenate([[False], keep])
+    thresholded = np.where(keep_label[labels], volumes, 0).reshape(n_con, -1)
+    thresholded = thresholded[:, np.flatnonzero(mask)]
+
+    xyz = peaks[:, 1:]
+    if affine is not None:
+        xyz = xyz @ affine[:3, :3].T + affine[:3, 3]
+    table = pd.DataFrame({'contrast': peaks[:, 0], 'size': sizes, 'peak_t': peak_t,
+                          'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2], 'p_unc': p_unc})
+    table = table[keep].sort_values(['contrast', 'size'], ascending=[True, False])
+
+    return thresholded, table, u
+
+#%%
+def read_spm_xvol(spm_mat_file):
+    '''
+    Error degrees of freedom and resel counts from SPM.mat
+
+    Output:
+        df: SPM.xX.erdf
+        resels: SPM.xVol.R (R0 to R3)
+    '''
+    import scipy.io as spio
+
+    spm = spio.loadmat(spm_mat_file, struct_as_record=False, squeeze_me=True)['SPM']
+
+    return float(spm.xX.erdf), np.asarray(spm.xVol.R, dtype=np.float64)
+
+#%%
+def threshold_contrast_dirs(out_dir, contrasts, df=None, resels=None, con_files=None,
+                            cohort_dir=None, subjects=None, stat_name='spmT_0001', **kwargs):
+    '''
+    Threshold the second-level t maps of all contrasts in a sink folder
+
+    Input:
+        out_dir: e.g. Sink_resp/2ndLevel_heightp05, with
+            _contrast_id_<contrast>/spmT_0001.nii
+        contrasts: list of contrast names
+        df, resels: default from each contrast folder's SPM.mat
+        con_files: without SPM.mat, optional list (contrasts) of lists
+            (subjects) of con images: resels are then estimated from the
+            group residuals, streamed (smoothness.py); otherwise resels are
+            None (Bonferroni)
+        cohort_dir: without SPM.mat, the cohort (cohort_tensor.py) to take
+            the group residuals from instead of the con images
+        subjects: subjects of the group model in the cohort, default all
+        stat_name: name of the t maps
+        kwargs: threshold_maps options (height, fwe, extent, ...)
+
+    Output:
+        out_files: dict, contrast: thresholded map (spmT_0001_thr.nii)
+    '''
+    import nibabel as nib
+    from smoothness import estimate_smoothness, group_residual_chunks, stack_residual_chunks
+
+    con_dirs = [os.path.join(out_dir, '_contrast_id_%s' % contrast) for contrast in contrasts]
+    spm_mat_files = [os.path.join(con_dir, 'SPM.mat') for con_dir in con_dirs]
+    if (df is None or resels is None) and all(os.path.exists(f) for f in spm_mat_files):
+        xvol = [read_spm_xvol(spm_mat_file) for spm_mat_file in spm_mat_files]
+        df = xvol[0][0] if df is None else df
+        resels = np.array([R for (erdf, R) in xvol]) if resels is None else resels
+
+    imgs = [nib.load(os.path.join(con_dir, '%s.nii' % stat_name)) for con_dir in con_dirs]
+    volumes = np.stack([np.asanyarray(img.dataobj, dtype=np.float32) for img in imgs])
+    mask = np.all(np.isfinite(volumes) & (volumes != 0), axis=0)
+    voxel_index = np.flatnonzero(mask)
+
+    if resels is None and cohort_dir is not None:
+        from cohort_tensor import load_cohort_stack
+        # one read of the cohort file, contrast * subject * voxel
+        data, cohort_mask, _ = load_cohort_stack(cohort_dir, subjects, contrasts)
+        resels = np.array([estimate_smoothness(stack_residual_chunks(data_con, cohort_mask),
+                                               mask)[1]
+                           for data_con in data])
+    elif resels is None and con_files is not None:
+        resels = np.array([estimate_smoothness(group_residual_chunks(con_files_sub, mask), mask)[1]
+                           for con_files_sub in con_files])
+
+    thresholded, table, u = threshold_maps(volumes.reshape(len(imgs), -1)[:, voxel_index],
+                                           mask, df, resels, affine=imgs[0].affine,
+                                           **kwargs)
+
+    out_files = {}
+    for (con_idx, contrast) in enumerate(contrasts):
+        vol = np.zeros(mask.size, dtype=np.float32)
+        vol[voxel_index] = thresholded[con_idx]
+        out_file = os.path.join(con_dirs[con_idx], '%s_thr.nii' % stat_name)
+        nib.Nifti1Image(vol.reshape(mask.shape), imgs[con_idx].affine).to_filename(out_file)
+        out_files[contrast] = out_file
+
+        con_table = table[table['contrast'] == con_idx].drop(columns='contrast')
+        con_table.insert(0, 'cluster', np.arange(1, len(con_table) + 1))
+        con_table.to_csv(os.path.join(con_dirs[con_idx], 'clusters.csv'), index=False)
+
+    return out_files